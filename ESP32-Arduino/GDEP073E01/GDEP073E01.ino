@@ -20,7 +20,9 @@
 #define GET_IMAGE_CHUNK_ENDPOINT "/get-chunk"
 #define GET_IMAGE_ENDPOINT "/get-img-data"
 #define GET_WAKEUP_INTERVAL "/wakeup-interval"
-#define LOG_ENDPOINT "/device-log"
+#define LOG_BATCH_ENDPOINT "/device-logs"
+
+#define LOG_BUFFER_SIZE 4096      // Bytes of log entries kept until they are sent to the server
 
 #define BYTES_PER_PIXEL 1
 
@@ -82,6 +84,13 @@ const uint32_t g_width        = EPD_WIDTH;
 const uint32_t g_height       = EPD_HEIGHT;
 const uint8_t  g_palette_size = 7;
 
+// Log entries are buffered as comma separated JSON objects and sent once per wake. The buffer is kept in
+// RTC memory so entries from a wake that never reached the server are sent on the next one.
+RTC_DATA_ATTR char     s_log_buffer[LOG_BUFFER_SIZE];
+RTC_DATA_ATTR uint32_t s_log_buffer_length = 0;
+RTC_DATA_ATTR uint32_t s_log_dropped       = 0;
+RTC_DATA_ATTR uint32_t s_wake_count        = 0;
+
 void set_rgb_led(uint8_t color, uint32_t duration_ms = 0, uint32_t loops = 1, uint32_t loop_duration_off_ms = -1);
 void log_message(const char* message, LogLevel level = LOG_INFO);
 
@@ -119,6 +128,7 @@ void loop()
     */
 
     int sleep_interval = SLEEP_INTERVAL_DEFAULT;
+    s_wake_count++;
 
     set_rgb_led(RGB_YELLOW, 50, 5, 20); // Notify entering main loop
 
@@ -337,17 +347,48 @@ void log_message(const char* message, LogLevel level)
     // Always print to Serial
     Serial.println(formatted_message);
     
-    // Only attempt server communication if connected to backend
-    if (s_is_connected_to_server)
+    // Buffer the entry for flush_logs, the server receives all of them in one request
+    String escaped_message = escape_json_string(message);
+    char entry[512];  // Increased buffer size to accommodate escaped characters
+    int entry_length = snprintf(entry, sizeof(entry),
+                                "%s{\"message\":\"%s\",\"level\":\"%s\",\"wake\":%lu,\"ms\":%lu}",
+                                s_log_buffer_length > 0 ? "," : "",
+                                escaped_message.c_str(), log_level_to_string(level),
+                                (unsigned long)s_wake_count, millis());
+    
+    if (entry_length < 0 || entry_length >= (int)sizeof(entry) || s_log_buffer_length + entry_length >= LOG_BUFFER_SIZE)
     {
-        String escaped_message = escape_json_string(message);
-        char payload[512];  // Increased buffer size to accommodate escaped characters
-        snprintf(payload, sizeof(payload),
-                 "{\"message\":\"%s\",\"level\":\"%s\",\"device_id\":\"%s\"}",
-                 escaped_message.c_str(), log_level_to_string(level), get_device_id().c_str());
-                 
-        http_post(LOG_ENDPOINT, payload);
+        s_log_dropped++;
+        return;
+    }
+    
+    memcpy(s_log_buffer + s_log_buffer_length, entry, entry_length);
+    s_log_buffer_length += entry_length;
+}
+
+bool flush_logs()
+{
+    // Keep the entries for the next wake if the server can't be reached now
+    if (!s_is_connected_to_server || (s_log_buffer_length == 0 && s_log_dropped == 0))
+    {
+        return false;
+    }
+    
+    String payload;
+    payload.reserve(s_log_buffer_length + 128);
+    payload += "{\"device_id\":\"" + get_device_id() + "\",\"dropped\":" + String(s_log_dropped) + ",\"entries\":[";
+    payload.concat(s_log_buffer, s_log_buffer_length);
+    payload += "]}";
+    
+    if (!http_post(LOG_BATCH_ENDPOINT, payload.c_str(), 10000).success)
+    {
+        Serial.println("Failed to send log entries");
+        return false;
     }
+    
+    s_log_buffer_length = 0;
+    s_log_dropped = 0;
+    return true;
 }
 
 bool connect_wifi() 
@@ -411,6 +452,9 @@ void hibernate(int interval)
     snprintf(msg, sizeof(msg), "Setting sleep timer for %llu microseconds", sleep_time);
     log_message(msg, LOG_INFO);
 
+    // Send everything logged during this wake in a single request
+    flush_logs();
+
     cleanup();
 
     delay(1000);
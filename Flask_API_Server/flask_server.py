@@ -1,19 +1,39 @@
+import os
+
+# 'production' serves with eventlet: green threads keep slow device connections and
+# Immich requests from pinning OS threads. Monkey patching must run before other imports.
+SERVER_MODE = os.getenv('SERVER_MODE', 'development')
+if SERVER_MODE == 'production':
+    import eventlet
+    eventlet.monkey_patch()
+    import eventlet.tpool
+
 from datetime import datetime, time as datetime_time, timedelta
 import time
 import uuid
 from flask import Flask, Response, render_template, request, jsonify, send_from_directory
-from image_helper import apply_floyd_steinberg_dithering, default_color_palette
-import os
+from image_helper import (
+    DITHERING_METHODS, MULTIPROCESS_DITHERING_METHODS, apply_dithering, image_to_palette_codes, palette_from_profile
+)
 from PIL import Image
 import io
-from immich_helper import ImmichHelper, ImmichScaleMode
+from immich_helper import ORIGINAL_CACHE_VERSION, ImmichHelper, ImmichScaleMode
+from state_helper import create_state_backend
+from frame_helper import FrameStore
+from log_helper import DeviceLogStore
+from prefetch_helper import BandwidthLimiter, directory_size
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.wsgi import wrap_file
 from flask_socketio import SocketIO, emit
 import threading
 import socket
 from pathlib import Path
 import json
+import hashlib
+import zlib
 import requests  # Add this at the top with other imports
 import atexit
+from functools import wraps
 
 GLOBAL_CONFIG_FILE = './config/global_config.json'
 
@@ -41,9 +61,6 @@ def load_global_config():
     
     return default_config
 
-# Load global configuration
-global_config = load_global_config()
-
 ###########
 # GLOBALS #
 ###########
@@ -52,21 +69,77 @@ BROADCAST_PORT = 9998
 DEVICE_RESPONSE_PORT = 9999
 HTTP_SERVER_PORT = 9999
 BROADCAST_INTERVAL = float(os.getenv('BROADCAST_INTERVAL', '1.0'))  # Interval in seconds
+MAX_CONNECTIONS = int(os.getenv('MAX_CONNECTIONS', '4096'))  # Concurrent connections in production mode
 DEVICES_FILE = './config/devices.json'
-Path('./config').mkdir(exist_ok=True)
+# 'memory' keeps state in this process, 'sqlite' shares it between server instances
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', './config/state.db')
+TRANSFER_TTL = int(os.getenv('TRANSFER_TTL', '3600'))  # Seconds an unfinished transfer is kept
+FRAME_CACHE_TTL = int(os.getenv('FRAME_CACHE_TTL', '3600'))  # Seconds a rendered frame is kept
+# Rendered frames are files here, shared like the image cache when instances share the volume
+FRAME_PATH = os.getenv('FRAME_PATH', os.path.join(os.getenv('IMAGE_PATH', './images'), 'frames'))
+# Device logs are appended per device and rotated once a file reaches DEVICE_LOG_MAX_BYTES
+DEVICE_LOG_PATH = os.getenv('DEVICE_LOG_PATH', './config/logs')
+DEVICE_LOG_MAX_BYTES = int(os.getenv('DEVICE_LOG_MAX_BYTES', str(1024 * 1024)))
+DEVICE_LOG_BACKUPS = int(os.getenv('DEVICE_LOG_BACKUPS', '3'))
+MAX_LOG_BATCH_BYTES = 256 * 1024  # Largest log batch accepted, after decompression
+# The prefetcher renders the next PREFETCH_AHEAD images of every group before devices ask for them.
+# Downloads share PREFETCH_BANDWIDTH bytes/s (0 = unlimited) and it pauses while IMAGE_PATH exceeds CACHE_BUDGET_MB.
+PREFETCH_AHEAD = int(os.getenv('PREFETCH_AHEAD', '3'))
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', '2'))
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', '60'))  # Seconds between prefetch passes
+PREFETCH_BANDWIDTH = int(os.getenv('PREFETCH_BANDWIDTH', '0'))
+CACHE_BUDGET_MB = int(os.getenv('CACHE_BUDGET_MB', '2048'))
+STARTUP_TIMEOUT = float(os.getenv('STARTUP_TIMEOUT', '10'))  # Seconds a request waits for startup to finish
+
+global_config = {
+    'wakeup_interval': int(os.getenv('WAKEUP_INTERVAL', '60'))
+}
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
-socketio = SocketIO(app)
-immich = ImmichHelper(
-    config_path='./config/immich_config.json',
-    image_path=os.getenv('IMAGE_PATH', './images'),
-    server_url=os.getenv('IMMICH_URL', global_config['immich']['url']),
-    api_key=os.getenv('IMMICH_API_KEY', global_config['immich']['api_key'])
-)
+# With several instances, a message queue (e.g. redis://) relays Socket.IO events between them
+socketio = SocketIO(app, async_mode='eventlet' if SERVER_MODE == 'production' else 'threading',
+                    message_queue=os.getenv('SOCKETIO_MESSAGE_QUEUE') or None)
 
-active_transfers = {}
-devices = {}
-groups = {}
+# Created on first use so a missing API key doesn't stop the server from starting
+_immich = None
+_immich_lock = threading.Lock()
+
+def get_immich():
+    """Get the Immich client, creating it on first use"""
+    global _immich
+    with _immich_lock:
+        if _immich is None:
+            file_config = load_global_config()
+            _immich = ImmichHelper(
+                config_path='./config/immich_config.json',
+                image_path=os.getenv('IMAGE_PATH', './images'),
+                server_url=os.getenv('IMMICH_URL', file_config['immich']['url']),
+                api_key=os.getenv('IMMICH_API_KEY', file_config['immich']['api_key'])
+            )
+        return _immich
+
+def run_cpu_bound(func, *args, **kwargs):
+    """Run CPU-heavy work off the event loop in production mode so other connections keep being served"""
+    if SERVER_MODE == 'production':
+        return eventlet.tpool.execute(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+# Devices, groups and transfers live in the state backend so that any server instance
+# sharing it can answer any device. It and the frame and log stores are opened by initialize_state.
+state = None
+frame_store = None
+log_store = None
+_ready = threading.Event()
+
+def requires_ready(func):
+    """Hold a request until startup has loaded the state, or answer 503 if it takes too long"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _ready.wait(STARTUP_TIMEOUT):
+            return jsonify({'error': 'Server is starting'}), 503
+        return func(*args, **kwargs)
+    return wrapper
 
 def load_devices():
     """Load devices from file"""
@@ -76,16 +149,31 @@ def load_devices():
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
+def all_devices():
+    """Snapshot of all devices"""
+    return state.items('devices')
+
 def save_devices():
     """Save devices to file"""
-    with open(DEVICES_FILE, 'w') as f:
-        json.dump(devices, f, indent=4)
+    if state is None:
+        return
+    # Write to a temporary file first so concurrent instances never leave a partial file
+    tmp_file = f"{DEVICES_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(all_devices(), f, indent=4)
+    os.replace(tmp_file, DEVICES_FILE)
 
-# Load devices at startup
-devices = load_devices()
+def save_device(device_id, device):
+    """Store a device's updated info"""
+    state.set('devices', device_id, device)
+    save_devices()
 
-# Register save function to run on exit
-atexit.register(save_devices)
+def touch_device(device_id):
+    """Record that a device was heard from, without rewriting the devices file"""
+    device = state.get('devices', device_id)
+    if device:
+        device['last_seen'] = datetime.now().isoformat()
+        state.set('devices', device_id, device)
 
 # Add HOST_IP to globals section
 HOST_IP = os.getenv('HOST_IP', None)  # Will be set via environment variable
@@ -134,30 +222,92 @@ def get_local_ip():
 
 # Add device cleanup task
 def cleanup_disconnected_devices():
+    _ready.wait()
     while True:
         try:
             current_time = datetime.now()
-            for device_id in list(devices.keys()):
-                device = devices[device_id]
+            for device_id, device in all_devices().items():
                 last_seen = datetime.fromisoformat(device.get('last_seen', '2000-01-01T00:00:00'))
                 
                 # Mark device as inactive if not seen for 2 minutes
-                if current_time - last_seen > timedelta(minutes=2):
+                if current_time - last_seen > timedelta(minutes=2) and device.get('active'):
                     device['active'] = False
-                    socketio.emit('device_update', devices)
+                    state.set('devices', device_id, device)
+                    socketio.emit('device_update', all_devices())
                 
                 # Only remove device if not seen for 30 days
                 if current_time - last_seen > timedelta(days=30):
-                    del devices[device_id]
-                    socketio.emit('device_update', devices)
+                    state.delete('devices', device_id)
+                    socketio.emit('device_update', all_devices())
                     print(f"Removed device inactive for 30 days: {device_id}")
+
+            # Drop abandoned transfers and stale rendered frames, keeping frames at least as long as their transfers
+            state.purge_expired()
+            frame_store.purge(max(FRAME_CACHE_TTL, TRANSFER_TTL))
         except Exception as e:
             print(f"Error in cleanup task: {str(e)}")
         finally:
             time.sleep(60)  # Run cleanup every minute
 
-# Start the cleanup task
-threading.Thread(target=cleanup_disconnected_devices, daemon=True).start()
+def prefetch_image(image_id, targets, limiter):
+    """Download an image and render it for each (device, group) target, returning the bytes added to disk"""
+    added = 0
+    pending = []
+    for device, group in targets:
+        palette, dithering = frame_settings(device, group)
+        frame_key = frame_key_for(image_id, device, palette, dithering)
+        if frame_store.exists(frame_key):
+            # Keep upcoming frames from being purged while they wait for their device
+            frame_store.touch(frame_key)
+        else:
+            pending.append((frame_key, device, palette, dithering))
+    if pending:
+        added += get_immich().cache_image(image_id, limiter)
+        for frame_key, device, palette, dithering in pending:
+            added += render_frame(frame_key, image_id, device, palette, dithering)
+    return added
+
+def prefetch_frames():
+    """Keep the next images of every group downloaded and rendered for all of its devices"""
+    _ready.wait()
+    limiter = BandwidthLimiter(PREFETCH_BANDWIDTH) if PREFETCH_BANDWIDTH > 0 else None
+    executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+    image_path = os.getenv('IMAGE_PATH', './images')
+    while True:
+        try:
+            budget = CACHE_BUDGET_MB * 1024 * 1024 - directory_size(image_path)
+            if budget <= 0:
+                print("Image cache is over budget, prefetching paused")
+                continue
+            
+            # Devices sharing a geometry and settings share frames, render once for all of them
+            devices = all_devices()
+            for group_id, group in state.items('groups').items():
+                if not group.get('album'):
+                    continue
+                targets = {}
+                for device in devices.values():
+                    if device.get('group_id') == group_id:
+                        palette, dithering = frame_settings(device, group)
+                        targets.setdefault(frame_key_for('', device, palette, dithering), (device, group))
+                if not targets:
+                    continue
+                
+                upcoming = get_immich().get_upcoming_images(group['album'], group_id, PREFETCH_AHEAD)
+                # Images in shuffle order, each on one worker, so the soonest shown are ready first
+                for future in [executor.submit(prefetch_image, image_id, list(targets.values()), limiter)
+                               for image_id in upcoming]:
+                    try:
+                        budget -= future.result()
+                    except Exception as e:
+                        print(f"Error prefetching for group {group_id}: {str(e)}")
+                if budget <= 0:
+                    print("Image cache budget reached, prefetching paused")
+                    break
+        except Exception as e:
+            print(f"Error in prefetch task: {str(e)}")
+        finally:
+            time.sleep(PREFETCH_INTERVAL)
 
 def broadcast_server_presence():
     """Broadcasts server presence on the network"""
@@ -194,28 +344,54 @@ def broadcast_server_presence():
 # FLASK SERVER #
 ################
 
+def read_json_body(max_bytes):
+    """Parse the request body as JSON, inflating it first if it was sent gzip or deflate encoded"""
+    if request.content_length and request.content_length > max_bytes:
+        raise ValueError('Request body too large')
+    # Chunked bodies have no Content-Length, so read with the limit rather than trust the header
+    body = bytearray()
+    while len(body) <= max_bytes:
+        block = request.stream.read(max_bytes + 1 - len(body))
+        if not block:
+            break
+        body += block
+    if len(body) > max_bytes:
+        raise ValueError('Request body too large')
+    body = bytes(body)
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    if encoding in ('gzip', 'deflate'):
+        # Cap the inflated size so a small compressed body can't expand without bound
+        inflater = zlib.decompressobj(zlib.MAX_WBITS | 16 if encoding == 'gzip' else zlib.MAX_WBITS)
+        body = inflater.decompress(body, max_bytes + 1)
+        if len(body) > max_bytes or not inflater.eof:
+            raise ValueError('Request body too large')
+    elif encoding != 'identity':
+        raise ValueError(f"Unsupported content encoding: {encoding}")
+    return json.loads(body)
+
+def format_log_line(device_id, entry):
+    """Format a device log entry like the ESP32's serial output, with the server receive time"""
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    # Batched entries carry the wake they were logged in and the milliseconds since it started
+    uptime = f" [wake {entry['wake']} +{entry['ms']}ms]" if 'wake' in entry and 'ms' in entry else ''
+    return f"[{timestamp}] [{device_id}] [{entry['level']}]{uptime} {entry['message']}"
+
 @app.route('/device-log', methods=['POST'])
+@requires_ready
 def device_log():
+    """Single log entry, kept for firmware that doesn't batch its logs"""
     try:
         data = request.get_json()
-        print(f"Received log data: {data}")  # Debug print to see what we're receiving
         
         # Validate required fields that match ESP32's log_message format
         if not all(key in data for key in ['message', 'level', 'device_id']):
             print(f"Missing required fields. Received fields: {list(data.keys())}")
             return jsonify({'error': 'Missing required fields (message, level, device_id)'}), 400
             
-        # Format log message similar to ESP32's format
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_entry = f"[{timestamp}] [{data['device_id']}] [{data['level']}] {data['message']}"
-        
-        # Print to console
-        print(log_entry)
+        log_store.append(data['device_id'], [format_log_line(data['device_id'], data)])
         
         # Update device's last_seen time since we got a message from it
-        if data['device_id'] in devices:
-            devices[data['device_id']]['last_seen'] = datetime.now().isoformat()
-            save_devices()
+        touch_device(data['device_id'])
             
         return jsonify({'status': 'ok'})
         
@@ -226,12 +402,88 @@ def device_log():
         print(f"Error processing log message: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/device-logs', methods=['POST'])
+@requires_ready
+def device_logs():
+    """Batch of log entries sent by a device once per wake, optionally gzip or deflate encoded"""
+    try:
+        try:
+            data = read_json_body(MAX_LOG_BATCH_BYTES)
+        except (ValueError, zlib.error) as e:
+            # Covers bad JSON, bad compression and oversized bodies
+            return jsonify({'error': f"Invalid log batch: {str(e)}"}), 400
+        
+        device_id = data.get('device_id') if isinstance(data, dict) else None
+        entries = data.get('entries') if isinstance(data, dict) else None
+        if not device_id or not isinstance(entries, list):
+            return jsonify({'error': 'Missing required fields (device_id, entries)'}), 400
+        if not all(isinstance(entry, dict) and 'message' in entry and 'level' in entry for entry in entries):
+            return jsonify({'error': 'Each entry needs message and level'}), 400
+        
+        lines = [format_log_line(device_id, entry) for entry in entries]
+        if data.get('dropped'):
+            lines.append(format_log_line(device_id, {
+                'level': 'WARNING', 'message': f"{data['dropped']} log entries dropped, device log buffer was full"
+            }))
+        log_store.append(device_id, lines)
+        
+        # Errors still reach the console, everything else only goes to the log file
+        for line, entry in zip(lines, entries):
+            if entry['level'] == 'ERROR':
+                print(line)
+        
+        touch_device(device_id)
+        return jsonify({'status': 'ok', 'received': len(entries)})
+        
+    except Exception as e:
+        print(f"Error processing log batch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/wakeup-interval', methods=['GET'])
 def wakeup_interval():
     interval = global_config['wakeup_interval']
     return jsonify(interval=interval * 60)
 
+def frame_settings(device, group):
+    """Palette and dithering method a device's frames are rendered with"""
+    # Use the panel's measured palette if it sent one; a device's dithering method overrides its group's
+    palette = palette_from_profile(device.get('palette'))
+    dithering = device.get('dithering') or group.get('dithering')
+    return palette, dithering
+
+def frame_key_for(image_id, device, palette, dithering):
+    """Key of a rendered frame, shared by every device with the same geometry and settings"""
+    return hashlib.sha1(json.dumps([
+        image_id, device['width'], device['height'], device.get('scale_mode', 'crop'),
+        dithering, sorted(palette.items()), get_immich().config['immich'],
+        ORIGINAL_CACHE_VERSION  # Frames rendered from an older original format are not reused
+    ], sort_keys=True).encode()).hexdigest()
+
+def render_frame(frame_key, image_id, device, palette, dithering):
+    """Scale, dither and palette-encode an image for a device, store it and return its size"""
+    # Use device specs stored during registration
+    image_bytes = run_cpu_bound(
+        get_immich().get_image,
+        image_id,
+        width=device['width'],
+        height=device['height'],
+        scale_mode=ImmichScaleMode(device.get('scale_mode', 'crop'))  # Default to crop if not set
+    )
+    
+    img = Image.open(io.BytesIO(image_bytes))
+    if dithering in MULTIPROCESS_DITHERING_METHODS:
+        # The work happens on worker processes, waiting for them doesn't need a tpool thread
+        dithered = apply_dithering(img, palette, dithering)
+    else:
+        dithered = run_cpu_bound(apply_dithering, img, palette, dithering)
+    
+    # Convert to single channel using palette
+    img_bytes = run_cpu_bound(image_to_palette_codes, dithered, palette)
+    frame_store.write(frame_key, img_bytes)
+    return len(img_bytes)
+
 @app.route('/init-transfer', methods=['POST'])
+@requires_ready
 def init_transfer():
     try:
         print("\n=== Init Transfer Request ===")
@@ -241,32 +493,30 @@ def init_transfer():
         print(f"Request from IP: {request.remote_addr}")
         print(f"Device ID: {device_id}")
         print(f"Headers: {dict(request.headers)}")
-        print(f"Current devices: {devices}")
-        
         if not device_id:
             print("Error: Missing device ID")
             return jsonify({'error': 'Missing device ID'}), 400
             
-        if device_id not in devices:
+        device = state.get('devices', device_id)
+        if not device:
             print(f"Error: Unknown device ID: {device_id}")
-            print("Known devices:", list(devices.keys()))
+            print("Known devices:", list(all_devices().keys()))
             return jsonify({'error': f'Unknown device ID: {device_id}'}), 400
 
-        device = devices[device_id]
         print(f"Found device: {device}")
         
         # Update last seen time
         device['last_seen'] = datetime.now().isoformat()
         device['active'] = True
-        save_devices()
+        save_device(device_id, device)
 
         # Validate group assignment
         group_id = device.get('group_id')
-        if not group_id or group_id not in groups:
+        group = state.get('groups', group_id) if group_id else None
+        if not group:
             print(f"Error: Device not in group. Device: {device_id}, Group: {group_id}")
             return jsonify({'error': 'Device not assigned to a group'}), 400
 
-        group = groups[group_id]
         album_id = group.get('album')  # Note: This is now correctly an album ID
         if not album_id:
             print(f"Error: Group has no album. Group: {group_id}")
@@ -275,54 +525,43 @@ def init_transfer():
         print(f"Using album: {album_id} for group: {group_id}")
         print(f"Using scale mode: {device.get('scale_mode', 'crop')} for device: {device_id}")
 
-        # Use device specs stored during registration
+        palette, dithering = frame_settings(device, group)
         try:
-            image_id, image_bytes = immich.get_random_image(
-                album_id=album_id,
-                width=device['width'],
-                height=device['height'], 
-                scale_mode=ImmichScaleMode(device.get('scale_mode', 'crop')),  # Default to crop if not set
-                group_id=group_id
-            )
+            image_id = get_immich().next_image_id(album_id, group_id)
+            
+            # Usually the prefetcher has rendered it already, or another device with the same geometry and settings did
+            frame_key = frame_key_for(image_id, device, palette, dithering)
+            if frame_store.exists(frame_key):
+                frame_store.touch(frame_key)
+                image_size = frame_store.size(frame_key)
+            else:
+                print(f"Frame cache miss for image {image_id}, rendering now")
+                image_size = render_frame(frame_key, image_id, device, palette, dithering)
         except Exception as e:
             print(f"Error retrieving image: {str(e)}")
             return jsonify({'error': str(e)}), 500
-
-        # Convert bytes to image for dithering
-        img = Image.open(io.BytesIO(image_bytes))
-        dithered = apply_floyd_steinberg_dithering(img)
-        
-        # Convert to single channel using palette
-        img_bytes = bytearray()
-        for y in range(device['height']):
-            for x in range(device['width']):
-                rgb = dithered.getpixel((x, y))
-                color_code = default_color_palette.get(tuple(rgb), 0xFF)
-                img_bytes.append(color_code)
-                
-        img_bytes = bytes(img_bytes)
         
         # Use buffer size from device registration
         buffer_size = device['buffer_size']
-        if len(img_bytes) % buffer_size != 0:
+        if image_size % buffer_size != 0:
             return jsonify({
                 'error': 'Buffer size must be multiple of image size',
-                'image_size': len(img_bytes),
+                'image_size': image_size,
                 'buffer_size': buffer_size
             }), 400
             
         transfer_id = str(uuid.uuid4())
-        active_transfers[transfer_id] = {
-            'image_data': img_bytes,
-            'total_chunks': len(img_bytes) // buffer_size,
-            'buffer_size': buffer_size,
-            'sent_chunks': 0
+        transfer = {
+            'frame_key': frame_key,
+            'total_chunks': image_size // buffer_size,
+            'buffer_size': buffer_size
         }
+        state.set('transfers', transfer_id, transfer, ttl=TRANSFER_TTL)
 
         return jsonify({
             'transfer_id': transfer_id,
-            'total_chunks': active_transfers[transfer_id]['total_chunks'],
-            'image_size': len(img_bytes)
+            'total_chunks': transfer['total_chunks'],
+            'image_size': image_size
         })
         
     except Exception as e:
@@ -330,44 +569,51 @@ def init_transfer():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/get-chunk/<transfer_id>/<int:chunk_index>', methods=['GET'])
+@requires_ready
 def get_chunk(transfer_id, chunk_index):
-    global active_transfers
     try:
         print(f"[{datetime.now()}] Chunk request: ID={transfer_id}, index={chunk_index}")
 
-        if transfer_id not in active_transfers:
+        transfer = state.get('transfers', transfer_id)
+        if not transfer:
             print(f"[{datetime.now()}] Error: Invalid transfer ID: {transfer_id}")
             return jsonify({'error': 'Invalid or expired transfer ID'}), 404
-            
-        transfer = active_transfers[transfer_id]
         
         if chunk_index >= transfer['total_chunks']:
             print(f"[{datetime.now()}] Error: Chunk index out of range: {chunk_index}")
             return jsonify({'error': 'Chunk index out of range'}), 400    
             
         start_idx = chunk_index * transfer['buffer_size']
-        end_idx = start_idx + transfer['buffer_size']
-        chunk = transfer['image_data'][start_idx:end_idx]
+        # Stream the chunk from the frame file in bounded reads instead of loading the frame
+        chunk = frame_store.open_chunk(transfer['frame_key'], start_idx, transfer['buffer_size'])
+        if chunk is None:
+            print(f"[{datetime.now()}] Error: Frame expired for transfer: {transfer_id}")
+            return jsonify({'error': 'Invalid or expired transfer ID'}), 404
         
-        # Update sent chunks count
-        transfer['sent_chunks'] += 1
+        # Update sent chunks count, shared by every instance serving this transfer
+        sent_chunks = state.incr('sent_chunks', transfer_id, ttl=TRANSFER_TTL)
         print(f"[{datetime.now()}] Sent chunk {chunk_index}/{transfer['total_chunks']-1} "
               f"for transfer {transfer_id}")
         
         # Clean up if transfer is complete
-        if transfer['sent_chunks'] == transfer['total_chunks']:
-            del active_transfers[transfer_id]
+        if sent_chunks == transfer['total_chunks']:
+            state.delete('transfers', transfer_id)
+            state.delete('sent_chunks', transfer_id)
             
-        return Response(chunk, mimetype='application/octet-stream')
+        response = Response(wrap_file(request.environ, chunk), mimetype='application/octet-stream',
+                            direct_passthrough=True)
+        response.content_length = transfer['buffer_size']
+        return response
         
     except Exception as e:
         print(f"[{datetime.now()}] Error serving chunk: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/groups', methods=['GET', 'POST'])
+@requires_ready
 def manage_groups():
     if request.method == 'GET':
-        return jsonify(groups)
+        return jsonify(state.items('groups'))
     elif request.method == 'POST':
         data = request.get_json()
         group_id = str(uuid.uuid4())
@@ -377,7 +623,7 @@ def manage_groups():
             'random': True,
             'created_at': datetime.now().isoformat()
         }
-        groups[group_id] = group_data
+        state.set('groups', group_id, group_data)
         
         # Create group directory and config
         group_config_path = Path(f'./config/groups/{group_id}.json')
@@ -390,54 +636,71 @@ def manage_groups():
 def validate_device_groups():
     """Ensure all devices have valid group assignments"""
     changes_made = False
-    for device_id, device in devices.items():
+    groups = state.items('groups')
+    for device_id, device in all_devices().items():
         if 'group_id' in device and device['group_id'] is not None:
             if device['group_id'] not in groups:
                 print(f"Removing invalid group assignment for device {device_id}")
                 device.pop('group_id', None)
+                state.set('devices', device_id, device)
                 changes_made = True
     
     if changes_made:
         save_devices()
-        socketio.emit('device_update', devices)
+        socketio.emit('device_update', all_devices())
 
 @app.route('/groups/<group_id>', methods=['GET', 'PUT', 'DELETE'])
+@requires_ready
 def manage_group(group_id):
+    group = state.get('groups', group_id)
     if request.method == 'GET':
-        if group_id in groups:
-            return jsonify(groups[group_id])
+        if group:
+            return jsonify(group)
         return jsonify({'error': 'Group not found'}), 404
     elif request.method == 'PUT':
+        if not group:
+            return jsonify({'error': 'Group not found'}), 404
         data = request.get_json()
-        groups[group_id].update(data)
+        if data.get('dithering') and data['dithering'] not in DITHERING_METHODS:
+            return jsonify({'error': f"Unknown dithering method: {data['dithering']}"}), 400
+        group.update(data)
+        state.set('groups', group_id, group)
         # Update group configuration file
         group_config_path = Path(f'./config/groups/{group_id}.json')
         with open(group_config_path, 'w') as f:
-            json.dump(groups[group_id], f, indent=4)
+            json.dump(group, f, indent=4)
         return jsonify({'status': 'updated'})
     elif request.method == 'DELETE':
         # Remove group assignment from all devices in this group
-        for device_id, device in devices.items():
+        for device_id, device in all_devices().items():
             if device.get('group_id') == group_id:
                 device.pop('group_id', None)
+                state.set('devices', device_id, device)
         save_devices()
-        socketio.emit('device_update', devices)  # Notify clients about device updates
+        socketio.emit('device_update', all_devices())  # Notify clients about device updates
         
         # Delete the group
-        del groups[group_id]
+        state.delete('groups', group_id)
         group_config_path = Path(f'./config/groups/{group_id}.json')
         if group_config_path.exists():
             group_config_path.unlink()
         return jsonify({'status': 'deleted'})
 
+@app.route('/dithering-methods', methods=['GET'])
+def get_dithering_methods():
+    return jsonify(sorted(DITHERING_METHODS))
+
 @app.route('/devices', methods=['GET'])
+@requires_ready
 def get_devices():
-    return jsonify(devices)
+    return jsonify(all_devices())
 
 @app.route('/devices/<device_id>/group', methods=['PUT'])
+@requires_ready
 def assign_device_to_group(device_id):
     try:
-        if (device_id not in devices):
+        device = state.get('devices', device_id)
+        if not device:
             return jsonify({'error': 'Device not found'}), 404
 
         data = request.get_json()
@@ -446,43 +709,63 @@ def assign_device_to_group(device_id):
         
         if group_id is None:
             # Remove device from group
-            devices[device_id].pop('group_id', None)
+            device.pop('group_id', None)
         else:
             # Verify group exists before assigning
-            if group_id not in groups:
+            if not state.get('groups', group_id):
                 return jsonify({'error': 'Group not found'}), 404
             # Assign device to group
-            devices[device_id]['group_id'] = group_id
+            device['group_id'] = group_id
             
         # Update was_assigned flag
         if was_assigned:
-            devices[device_id]['was_assigned'] = True
+            device['was_assigned'] = True
             
-        save_devices()  # Save after group assignment
-        socketio.emit('device_update', devices)  # Broadcast update to all clients
+        save_device(device_id, device)  # Save after group assignment
+        socketio.emit('device_update', all_devices())  # Broadcast update to all clients
         return jsonify({'status': 'updated'})
     except Exception as e:
         print(f"Error in assign_device_to_group: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/devices/<device_id>', methods=['GET'])
+@requires_ready
 def get_device_info(device_id):
-    device = devices.get(device_id)
+    device = state.get('devices', device_id)
     if device:
         return jsonify(device)
     else:
         return jsonify({'error': 'Device not found'}), 404
 
 @app.route('/devices/<device_id>/config', methods=['PUT'])
+@requires_ready
 def update_device_config(device_id):
     try:
-        if device_id not in devices:
+        device = state.get('devices', device_id)
+        if not device:
             return jsonify({'error': 'Device not found'}), 404
             
         data = request.get_json()
+        # Validate every field before saving any of them
         if 'scale_mode' in data:
-            devices[device_id]['scale_mode'] = data['scale_mode']
-            save_devices()
+            try:
+                ImmichScaleMode(data['scale_mode'])
+            except ValueError:
+                return jsonify({'error': f"Unknown scale mode: {data['scale_mode']}"}), 400
+        # An empty method falls back to the group's
+        if data.get('dithering') and data['dithering'] not in DITHERING_METHODS:
+            return jsonify({'error': f"Unknown dithering method: {data['dithering']}"}), 400
+        if 'palette' in data:
+            # An empty profile falls back to the default palette
+            try:
+                palette_from_profile(data['palette'], device.get('dithering_palette_size'))
+            except (KeyError, TypeError, ValueError) as e:
+                return jsonify({'error': f'Invalid palette profile: {e}'}), 400
+        
+        for key in ('scale_mode', 'dithering', 'palette'):
+            if key in data:
+                device[key] = data[key]
+        save_device(device_id, device)
             
         return jsonify({'status': 'updated'})
     except Exception as e:
@@ -490,6 +773,18 @@ def update_device_config(device_id):
 
 @app.route('/immich-status', methods=['GET'])
 def immich_status():
+    try:
+        immich = get_immich()
+    except Exception as e:
+        print(f"Immich client not available: {str(e)}")
+        return jsonify({
+            'server': None,
+            'connected': False,
+            'albums': 0,
+            'images': 0,
+            'wakeup_interval': global_config['wakeup_interval'],
+            'error': str(e)
+        })
     try:
         url = f"{immich.server_url}/api/albums"
         response = requests.get(url, headers=immich._get_headers(), timeout=5)
@@ -521,9 +816,10 @@ def immich_status():
         })
 
 @app.route('/groups/<group_id>/devices', methods=['GET'])
+@requires_ready
 def get_group_devices(group_id):
     group_devices = []
-    for device_id, device in devices.items():
+    for device_id, device in all_devices().items():
         if device.get('group_id') == group_id:
             # Include the device_id in the device info
             device_info = device.copy()
@@ -534,6 +830,7 @@ def get_group_devices(group_id):
 @app.route('/albums', methods=['GET'])
 def get_albums():
     try:
+        immich = get_immich()
         url = f"{immich.server_url}/api/albums"  # Use server_url instead of config
         response = requests.get(url, headers=immich._get_headers())
         response.raise_for_status()
@@ -551,6 +848,7 @@ def get_albums():
 
 # Add new endpoint for device registration
 @app.route('/device-register', methods=['POST'])
+@requires_ready
 def device_register():
     try:
         device_info = request.get_json()
@@ -563,15 +861,27 @@ def device_register():
 
         # Set IP from request
         device_info['ip'] = request.remote_addr
+
+        # Validate the measured palette profile if the device sent one
+        if device_info.get('palette'):
+            try:
+                palette_from_profile(device_info['palette'], device_info.get('dithering_palette_size'))
+            except (KeyError, TypeError, ValueError) as e:
+                return jsonify({'error': f'Invalid palette profile: {e}'}), 400
             
         # Preserve existing first_seen if it exists
-        if device_id in devices:
-            device_info['first_seen'] = devices[device_id].get('first_seen', current_time)
+        existing = state.get('devices', device_id)
+        if existing:
+            device_info['first_seen'] = existing.get('first_seen', current_time)
             # Preserve group assignment and scale mode if they exist
-            if 'group_id' in devices[device_id]:
-                device_info['group_id'] = devices[device_id]['group_id']
-            if 'scale_mode' in devices[device_id]:
-                device_info['scale_mode'] = devices[device_id]['scale_mode']
+            if 'group_id' in existing:
+                device_info['group_id'] = existing['group_id']
+            if 'scale_mode' in existing:
+                device_info['scale_mode'] = existing['scale_mode']
+            if 'dithering' in existing:
+                device_info['dithering'] = existing['dithering']
+            if 'palette' not in device_info and 'palette' in existing:
+                device_info['palette'] = existing['palette']
         else:
             device_info['first_seen'] = current_time
             # Set default scale mode for new devices
@@ -581,8 +891,8 @@ def device_register():
         device_info['last_seen'] = current_time
         device_info['active'] = True
         
-        devices[device_id] = device_info
-        save_devices()
+        save_device(device_id, device_info)
+        devices = all_devices()
         print(f"Current devices: {devices}")
         
         with app.app_context():
@@ -616,16 +926,36 @@ def load_groups():
             print(f"Error loading group {group_file}: {e}")
     return loaded_groups
 
-# Load both devices and groups at startup
-devices = load_devices()
-groups = load_groups()
-validate_device_groups()  # Add this line after loading both devices and groups
+def initialize_state():
+    """Open the state backend and load devices and groups, then mark the server ready"""
+    global state, frame_store, log_store
+    Path('./config').mkdir(exist_ok=True)
+    state = create_state_backend(STATE_BACKEND, STATE_DB_PATH)
+    frame_store = FrameStore(FRAME_PATH)
+    log_store = DeviceLogStore(DEVICE_LOG_PATH, DEVICE_LOG_MAX_BYTES, DEVICE_LOG_BACKUPS)
+
+    # Load both devices and groups at startup, unless another instance already filled the shared state
+    if not all_devices():
+        for device_id, device in load_devices().items():
+            state.set('devices', device_id, device)
+    if not state.items('groups'):
+        for group_id, group in load_groups().items():
+            state.set('groups', group_id, group)
+    validate_device_groups()  # Add this line after loading both devices and groups
+    _ready.set()
+    print("Server state loaded, ready for devices")
+
+    # Warm up the Immich client now rather than on the first device request
+    try:
+        get_immich()
+    except Exception as e:
+        print(f"Immich client not available: {e}")
 
 @app.route('/groups/<group_id>/album-tracking/<album_id>', methods=['GET'])
 def get_album_tracking(group_id, album_id):
     """Get tracking info for a group's album"""
     try:
-        total_count, shown_count = immich.get_group_tracking_stats(group_id, album_id)
+        total_count, shown_count = get_immich().get_group_tracking_stats(group_id, album_id)
         return jsonify({
             'total_count': total_count,
             'shown_count': shown_count
@@ -638,17 +968,12 @@ def get_album_tracking(group_id, album_id):
 def reset_album_tracking(group_id, album_id):
     """Reset tracking for a group's album"""
     try:
-        immich._reset_group_tracking(group_id)
+        get_immich()._reset_group_tracking(group_id)
         return jsonify({'status': 'reset successful'})
     except Exception as e:
         print(f"Error resetting album tracking: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-# Add default wakeup interval to global config
-global_config = {
-    'wakeup_interval': int(os.getenv('WAKEUP_INTERVAL', '60'))
-}
-
 @app.route('/config/wakeup-interval', methods=['PUT'])
 def update_wakeup_interval():
     try:
@@ -666,25 +991,62 @@ def update_immich_config():
         valid_keys = ['rotation', 'enhanced', 'contrast']
         update_data = {k: data[k] for k in valid_keys if k in data}
         if update_data:
-            immich.update_config({'immich': update_data})
+            get_immich().update_config({'immich': update_data})
         return jsonify({'status': 'updated'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe, OK once startup has loaded the state"""
+    if _ready.is_set():
+        return jsonify({'status': 'ready'})
+    return jsonify({'status': 'starting'}), 503
+
+_started = False
+
+def create_app():
+    """Start the background startup work and return the app
+
+    Requests are accepted immediately; those that need state wait for it (see requires_ready).
+    """
+    global _started
+    if not _started:
+        _started = True
+        threading.Thread(target=initialize_state, daemon=True).start()
+        threading.Thread(target=cleanup_disconnected_devices, daemon=True).start()
+        if PREFETCH_AHEAD > 0:
+            threading.Thread(target=prefetch_frames, daemon=True).start()
+        # Register save function to run on exit
+        atexit.register(save_devices)
+    return app
+
 ########
 # MAIN #
 ########
 
 # Run the Flask server
 if __name__ == '__main__':
+    create_app()
+
     # Start the broadcast thread
     threading.Thread(target=broadcast_server_presence, daemon=True).start()
     
     # Run Flask with SocketIO
-    socketio.run(
-        app,
-        host='0.0.0.0',
-        port=HTTP_SERVER_PORT,
-        allow_unsafe_werkzeug=True,
-        debug=False
-    )
+    if SERVER_MODE == 'production':
+        print(f"Serving with eventlet, up to {MAX_CONNECTIONS} concurrent connections")
+        socketio.run(
+            app,
+            host='0.0.0.0',
+            port=HTTP_SERVER_PORT,
+            max_size=MAX_CONNECTIONS,
+            debug=False
+        )
+    else:
+        socketio.run(
+            app,
+            host='0.0.0.0',
+            port=HTTP_SERVER_PORT,
+            allow_unsafe_werkzeug=True,
+            debug=False
+        )
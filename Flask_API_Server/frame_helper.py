@@ -0,0 +1,78 @@
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+class FrameChunk:
+    """File-like view of one chunk of a frame file
+
+    read() stops at the chunk end, so the response is streamed with bounded
+    reads and only a small buffer per transfer is ever in memory. There is
+    deliberately no fileno(): a sendfile-based file_wrapper could send past
+    the chunk end, and neither bundled server (werkzeug, eventlet) has one.
+    """
+
+    def __init__(self, file, length: int):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+class FrameStore:
+    """Rendered framebuffers on disk, one file per frame holding one byte per pixel
+
+    Chunk i of a transfer lives at offset i * buffer_size, so serving a chunk
+    is a seek and a bounded read and frames never need to sit in memory.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.bin"
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def size(self, key: str) -> int:
+        return self._path(key).stat().st_size
+
+    def touch(self, key: str):
+        """Mark a frame as recently used so purge keeps it"""
+        os.utime(self._path(key))
+
+    def write(self, key: str, data: bytes):
+        """Store a frame, atomically so concurrent readers never see a partial file"""
+        tmp_path = self.root / f"{key}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+
+    def open_chunk(self, key: str, offset: int, length: int) -> Optional[FrameChunk]:
+        """Open a chunk of a frame for streaming, or None if the frame is gone"""
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        f.seek(offset)
+        return FrameChunk(f, length)
+
+    def purge(self, max_age: float):
+        """Delete frames not written or used for max_age seconds"""
+        cutoff = time.time() - max_age
+        for path in self.root.glob('*'):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
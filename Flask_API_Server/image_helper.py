@@ -1,3 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import time
+import traceback
 from PIL import Image
 import numpy as np
 
@@ -11,39 +18,389 @@ default_color_palette = {
     (0, 0, 0): 0x00         # Black
 }
 
+# Bits kept per channel when indexing the palette lookup table (64x64x64 cells)
+PALETTE_LUT_BITS = 6
+_LUT_SHIFT = 8 - PALETTE_LUT_BITS
+
+def srgb_to_oklab(rgb):
+    """Convert an (..., 3) array of 0-255 sRGB values to OKLab."""
+    c = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    lms = linear @ np.array([
+        [0.4122214708, 0.2119034982, 0.0883024619],
+        [0.5363325363, 0.6806995451, 0.2817188376],
+        [0.0514459929, 0.1073969566, 0.6299787005],
+    ])
+    lms = np.cbrt(lms)
+    return lms @ np.array([
+        [0.2104542553, 1.9779984951, 0.0259040371],
+        [0.7936177850, -2.4285922050, 0.7827717662],
+        [-0.0040720468, 0.4505937099, -0.8086757660],
+    ])
+
+@lru_cache(maxsize=16)
+def _build_palette_lut(palette_colors):
+    """Precompute the nearest palette index (in OKLab) for every LUT cell."""
+    levels = np.arange(1 << PALETTE_LUT_BITS) << _LUT_SHIFT
+    levels = levels + (1 << _LUT_SHIFT) // 2  # Sample the center of each cell
+    r, g, b = np.meshgrid(levels, levels, levels, indexing='ij')
+    cells = srgb_to_oklab(np.stack([r, g, b], axis=-1).reshape(-1, 3))
+    targets = srgb_to_oklab(np.array(palette_colors))
+    dist = ((cells[:, None, :] - targets[None, :, :]) ** 2).sum(axis=-1)
+    return np.argmin(dist, axis=1).astype(np.uint8)
+
+def palette_lut(target_color_palette = default_color_palette):
+    """Return (palette colors, LUT of nearest color indices) for a palette."""
+    palette_colors = tuple(tuple(int(v) for v in rgb) for rgb in target_color_palette)
+    return palette_colors, _build_palette_lut(palette_colors)
+
+def _lut_index(r, g, b):
+    """LUT cell for an RGB value, clamping values pushed out of range by error diffusion."""
+    r = 0 if r < 0 else 255 if r > 255 else r
+    g = 0 if g < 0 else 255 if g > 255 else g
+    b = 0 if b < 0 else 255 if b > 255 else b
+    return ((r >> _LUT_SHIFT) << (2 * PALETTE_LUT_BITS)) | ((g >> _LUT_SHIFT) << PALETTE_LUT_BITS) | (b >> _LUT_SHIFT)
+
 def closest_palette_color(rgb, target_color_palette = default_color_palette):
-    """Find the closest color in the palette."""
-    min_dist = float('inf')
-    closest_color = (255, 255, 255)  # Default to white
-    for palette_rgb in target_color_palette:
-        # Cast to int32 to prevent overflow during calculations
-        dist = sum((int(rgb[i]) - int(palette_rgb[i])) ** 2 for i in range(3))
-        if dist < min_dist:
-            min_dist = dist
-            closest_color = palette_rgb
-    return closest_color
+    """Find the perceptually closest color in the palette."""
+    palette_colors, lut = palette_lut(target_color_palette)
+    return palette_colors[lut[_lut_index(int(rgb[0]), int(rgb[1]), int(rgb[2]))]]
+
+def palette_from_profile(profile, palette_size = None):
+    """Build a palette mapping from a measured panel profile.
+
+    The profile is a list of {"rgb": [r, g, b], "code": n} entries, as sent by a
+    device at registration, where rgb is the color the panel actually shows.
+    """
+    if not profile:
+        return default_color_palette
+    palette = {}
+    for entry in profile:
+        rgb = tuple(int(v) for v in entry['rgb'])
+        if len(rgb) != 3 or not all(0 <= v <= 255 for v in rgb):
+            raise ValueError(f"Invalid palette color: {entry['rgb']}")
+        code = int(entry['code'])
+        # Codes are sent to the panel as single bytes
+        if not 0 <= code <= 255:
+            raise ValueError(f"Invalid palette code: {entry['code']}")
+        palette[rgb] = code
+    if palette_size is not None and len(palette) > int(palette_size):
+        raise ValueError(f"Palette has {len(palette)} colors but device supports {palette_size}")
+    return palette
+
+# Error diffusion kernels as ((dx, dy, weight), ...) offsets from the current pixel, and their divisor
+ERROR_DIFFUSION_KERNELS = {
+    'floyd-steinberg': (((1, 0, 7), (-1, 1, 3), (0, 1, 5), (1, 1, 1)), 16),
+    # Atkinson only diffuses 6/8 of the error, which keeps highlights and shadows clean
+    'atkinson': (((1, 0, 1), (2, 0, 1), (-1, 1, 1), (0, 1, 1), (1, 1, 1), (0, 2, 1)), 8),
+    'stucki': (((1, 0, 8), (2, 0, 4),
+                (-2, 1, 2), (-1, 1, 4), (0, 1, 8), (1, 1, 4), (2, 1, 2),
+                (-2, 2, 1), (-1, 2, 2), (0, 2, 4), (1, 2, 2), (2, 2, 1)), 42),
+}
+
+DEFAULT_DITHERING_METHOD = 'floyd-steinberg'
+
+# Wavefront workers are forked so they don't re-import the server module
+_mp_context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+# Busy-waiting workers yield with a plain syscall so a monkey-patched sleep can't
+# hand control to green threads inherited from the server
+_yield_cpu = getattr(os, 'sched_yield', lambda: time.sleep(0))
+
+def apply_error_diffusion_dithering(image, target_color_palette = default_color_palette,
+                                    kernel = 'floyd-steinberg', serpentine = False):
+    """Apply error diffusion dithering with the given kernel, optionally alternating row direction."""
+    offsets, divisor = ERROR_DIFFUSION_KERNELS[kernel]
+    palette_colors, lut = palette_lut(target_color_palette)
+    lut = lut.tolist()
+    width, height = image.width, image.height
+    # Plain Python ints are much faster than numpy scalars in a per-pixel loop
+    rows = np.array(image.convert('RGB'), dtype=np.int32).tolist()
+    for y in range(height):
+        row = rows[y]
+        reverse = serpentine and y % 2 == 1
+        # Mirror the kernel horizontally on right-to-left rows
+        row_offsets = [(-dx if reverse else dx, dy, weight / divisor)
+                       for dx, dy, weight in offsets if y + dy < height]
+        for x in (range(width - 1, -1, -1) if reverse else range(width)):
+            old_pixel = row[x]
+            new_pixel = palette_colors[lut[_lut_index(*old_pixel)]]
+            err = [old_pixel[i] - new_pixel[i] for i in range(3)]
+            row[x] = list(new_pixel)
+
+            # Distribute the quantization error to neighboring pixels, truncating like the int16 cast did
+            for dx, dy, factor in row_offsets:
+                nx = x + dx
+                if 0 <= nx < width:
+                    p = rows[y + dy][nx]
+                    for i in range(3):
+                        p[i] += int(err[i] * factor)
+
+    # Every pixel now holds a palette color, so no clipping is needed
+    return Image.fromarray(np.array(rows, dtype=np.uint8))
 
 def apply_floyd_steinberg_dithering(image, target_color_palette = default_color_palette):
     """Apply Floyd-Steinberg dithering to the image."""
-    pixels = np.array(image, dtype=np.int16)  # Use int16 to allow negative values during error distribution
-    for y in range(image.height):
-        for x in range(image.width):
-            old_pixel = tuple(pixels[y, x][:3])
-            new_pixel = closest_palette_color(old_pixel, target_color_palette)
-            pixels[y, x][:3] = new_pixel
-            quant_error = np.array(old_pixel) - np.array(new_pixel)
-            
-            # Distribute the quantization error to neighboring pixels (convert to int16 before adding)
-            if x + 1 < image.width:
-                pixels[y, x + 1][:3] += (quant_error * 7 / 16).astype(np.int16)
-            if x - 1 >= 0 and y + 1 < image.height:
-                pixels[y + 1, x - 1][:3] += (quant_error * 3 / 16).astype(np.int16)
-            if y + 1 < image.height:
-                pixels[y + 1, x][:3] += (quant_error * 5 / 16).astype(np.int16)
-            if x + 1 < image.width and y + 1 < image.height:
-                pixels[y + 1, x + 1][:3] += (quant_error * 1 / 16).astype(np.int16)
-    
-    # Clip pixel values to be within 0-255 range after dithering
-    pixels = np.clip(pixels, 0, 255)
-    return Image.fromarray(pixels.astype(np.uint8))
-    
\ No newline at end of file
+    return apply_error_diffusion_dithering(image, target_color_palette, 'floyd-steinberg')
+
+def _wavefront_worker(worker, workers, shm_names, shape, kernel, palette_colors, progress, block):
+    """Dither every `workers`-th row, starting at `worker`, as part of a wavefront.
+
+    Errors pushed into lower rows go to a per-(row, dy) plane of shared memory so
+    that each value has a single writer. A row only reads a column once the row
+    above has published progress past every column that feeds it, and the row
+    above only flushes columns it will never touch again, so the sums (and the
+    per-contribution truncation) are exactly those of the serial pass.
+    """
+    height, width = shape
+    offsets, divisor = ERROR_DIFFUSION_KERNELS[kernel]
+    max_dy = max(dy for _, dy, _ in offsets)
+    lag = max(max(-dx for dx, dy, _ in offsets if dy > 0), 0)
+    lut = _build_palette_lut(palette_colors).tolist()
+    shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+    try:
+        source = np.ndarray((height, width, 3), dtype=np.int32, buffer=shms[0].buf)
+        incoming = np.ndarray((max_dy, height, width, 3), dtype=np.int32, buffer=shms[1].buf)
+        output = np.ndarray((height, width), dtype=np.uint8, buffer=shms[2].buf)
+        horizontal = [(dx, weight / divisor) for dx, dy, weight in offsets if dy == 0]
+
+        for y in range(worker, height, workers):
+            below = [(dx, dy, weight / divisor) for dx, dy, weight in offsets if dy > 0 and y + dy < height]
+            pending = {dy: [[0, 0, 0] for _ in range(width)] for dy in range(1, max_dy + 1) if y + dy < height}
+            row = source[y].tolist()
+            indices = bytearray(width)
+            loaded = width if y == 0 else 0
+            flushed = 0
+            ready = 0
+            for x in range(width):
+                if x >= loaded:
+                    # Wait for the row above to finish every column that feeds this one
+                    needed = min(width, x + lag + 1)
+                    while ready < needed:
+                        with progress.get_lock():
+                            ready = progress[y - 1]
+                        if ready < needed:
+                            _yield_cpu()
+                    new_loaded = width if ready == width else ready - lag
+                    errors = incoming[:, y, loaded:new_loaded].sum(axis=0).tolist()
+                    for i, error in enumerate(errors):
+                        p = row[loaded + i]
+                        for c in range(3):
+                            p[c] += error[c]
+                    loaded = new_loaded
+
+                old_pixel = row[x]
+                index = lut[_lut_index(*old_pixel)]
+                new_pixel = palette_colors[index]
+                indices[x] = index
+                err = [old_pixel[i] - new_pixel[i] for i in range(3)]
+
+                for dx, factor in horizontal:
+                    nx = x + dx
+                    if 0 <= nx < width:
+                        p = row[nx]
+                        for i in range(3):
+                            p[i] += int(err[i] * factor)
+                for dx, dy, factor in below:
+                    nx = x + dx
+                    if 0 <= nx < width:
+                        p = pending[dy][nx]
+                        for i in range(3):
+                            p[i] += int(err[i] * factor)
+
+                if (x + 1) % block == 0 or x + 1 == width:
+                    # Flush the columns no later pixel of this row can reach, then publish progress
+                    flush_to = width if x + 1 == width else max(flushed, x - lag + 1)
+                    # Blocks narrower than the kernel lag may have nothing safe to flush yet
+                    if flush_to > flushed:
+                        for dy, values in pending.items():
+                            incoming[dy - 1, y + dy, flushed:flush_to] = values[flushed:flush_to]
+                        flushed = flush_to
+                    with progress.get_lock():
+                        progress[y] = x + 1
+
+            output[y] = np.frombuffer(bytes(indices), dtype=np.uint8)
+    finally:
+        for shm in shms:
+            shm.close()
+
+def _run_wavefront_worker(*args):
+    """Worker process entry point.
+
+    Exits with os._exit so the forked copy of the server never runs its shutdown
+    hooks, which can block forever on green threads inherited from the parent.
+    """
+    try:
+        _wavefront_worker(*args)
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+def apply_wavefront_dithering(image, target_color_palette = default_color_palette,
+                              kernel = 'floyd-steinberg', workers = None, block = 32):
+    """Apply error diffusion dithering on several processes at once.
+
+    Rows are dealt round-robin to worker processes sharing the frame in shared
+    memory; row r runs a few pixels behind row r-1. The output matches
+    apply_error_diffusion_dithering exactly. Serpentine kernels cannot be
+    pipelined this way, as each row would wait for the whole row above.
+    """
+    workers = min(workers or os.cpu_count() or 1, image.height)
+    if workers <= 1:
+        return apply_error_diffusion_dithering(image, target_color_palette, kernel)
+
+    offsets, _ = ERROR_DIFFUSION_KERNELS[kernel]
+    max_dy = max(dy for _, dy, _ in offsets)
+    palette_colors, _ = palette_lut(target_color_palette)
+    width, height = image.width, image.height
+    pixels = np.array(image.convert('RGB'), dtype=np.int32)
+
+    sizes = (pixels.nbytes, max_dy * pixels.nbytes, width * height)
+    shms = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+    try:
+        np.ndarray(pixels.shape, dtype=np.int32, buffer=shms[0].buf)[...] = pixels
+        np.ndarray((max_dy,) + pixels.shape, dtype=np.int32, buffer=shms[1].buf)[...] = 0
+        progress = _mp_context.Array('q', height)
+        processes = [
+            _mp_context.Process(
+                target=_run_wavefront_worker,
+                args=(worker, workers, [shm.name for shm in shms], (height, width), kernel,
+                      palette_colors, progress, block),
+                daemon=True)
+            for worker in range(workers)
+        ]
+        for process in processes:
+            process.start()
+
+        # A failed worker would leave the rows below it waiting forever
+        while any(process.is_alive() for process in processes):
+            for process in processes:
+                process.join(0.05)
+                if process.exitcode not in (None, 0):
+                    for other in processes:
+                        other.terminate()
+                    raise RuntimeError(f"Wavefront dithering worker failed with exit code {process.exitcode}")
+
+        indices = np.ndarray((height, width), dtype=np.uint8, buffer=shms[2].buf)
+        return Image.fromarray(np.array(palette_colors, dtype=np.uint8)[indices])
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+@lru_cache(maxsize=None)
+def bayer_matrix(size = 8):
+    """Normalized (0-1) Bayer threshold matrix of a power-of-two size."""
+    matrix = np.zeros((1, 1))
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) / matrix.size
+
+@lru_cache(maxsize=None)
+def blue_noise_matrix(size = 64, seed = 0):
+    """Normalized (0-1) blue-noise threshold matrix.
+
+    Built by high-pass filtering white noise in the frequency domain and ranking
+    the result, which is cheap and good enough for a tiled threshold map.
+    """
+    noise = np.random.default_rng(seed).random((size, size))
+    fy = np.fft.fftfreq(size)[:, None]
+    fx = np.fft.fftfreq(size)[None, :]
+    high_pass = 1 - np.exp(-(fx ** 2 + fy ** 2) / (2 * 0.1 ** 2))
+    filtered = np.real(np.fft.ifft2(np.fft.fft2(noise) * high_pass))
+    ranks = np.argsort(np.argsort(filtered, axis=None)).reshape(size, size)
+    return (ranks + 0.5) / ranks.size
+
+@lru_cache(maxsize=16)
+def _palette_pairs(palette_colors):
+    """Every pair of palette colors as (first indices, second indices, first colors, second - first)."""
+    count = len(palette_colors)
+    pairs = [(i, j) for i in range(count) for j in range(i + 1, count)] or [(0, 0)]
+    first, second = np.array(pairs).T
+    colors = np.array(palette_colors, dtype=np.float32)
+    return first, second, colors[first], colors[second] - colors[first]
+
+def _ordered_dither_rows(pixels, y0, threshold, palette_colors):
+    """Pattern-dither a band of rows starting at image row y0.
+
+    Each pixel is matched to the pair of palette colors whose mix comes closest
+    to it, and the threshold picks one of the two in proportion to the mix, so
+    a tile averages to the input even when the palette colors are far apart.
+    """
+    first, second, start, span = _palette_pairs(palette_colors)
+    size = threshold.shape[0]
+    height, width = pixels.shape[:2]
+    ty = (np.arange(y0, y0 + height) % size)[:, None]
+    tx = (np.arange(width) % size)[None, :]
+
+    # Position of each pixel along every pair's segment (0 = first color, 1 = second) and its distance from it
+    offset = pixels[..., None, :] - start
+    mix = np.clip((offset * span).sum(axis=-1) / np.maximum((span * span).sum(axis=-1), 1e-6), 0, 1)
+    distance = ((offset - mix[..., None] * span) ** 2).sum(axis=-1)
+    best = np.argmin(distance, axis=-1)
+    mix = np.take_along_axis(mix, best[..., None], axis=-1)[..., 0]
+
+    index = np.where(threshold[ty, tx] < mix, second[best], first[best])
+    return np.array(palette_colors, dtype=np.uint8)[index]
+
+def apply_ordered_dithering(image, target_color_palette = default_color_palette,
+                            threshold = None, workers = 1, tile_rows = 64):
+    """Apply ordered dithering with a tiled threshold matrix (Bayer by default).
+
+    Every pixel is independent, so the image is split into bands of tile_rows
+    rows that are processed on up to `workers` threads (numpy releases the GIL).
+    """
+    if threshold is None:
+        threshold = bayer_matrix()
+    palette_colors, _ = palette_lut(target_color_palette)
+    pixels = np.array(image.convert('RGB'), dtype=np.float32)
+    output = np.empty(pixels.shape, dtype=np.uint8)
+
+    def dither_band(y0):
+        output[y0:y0 + tile_rows] = _ordered_dither_rows(pixels[y0:y0 + tile_rows], y0, threshold, palette_colors)
+
+    bands = range(0, image.height, tile_rows)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(dither_band, bands))
+    else:
+        for y0 in bands:
+            dither_band(y0)
+    return Image.fromarray(output)
+
+# Registry of dithering methods selectable per device or group: name -> func(image, palette)
+DITHERING_METHODS = {}
+# Methods that spawn their own worker processes
+MULTIPROCESS_DITHERING_METHODS = set()
+
+def register_dithering_method(name, func, multiprocess = False):
+    """Register a dithering function taking (image, target_color_palette)."""
+    DITHERING_METHODS[name] = func
+    if multiprocess:
+        MULTIPROCESS_DITHERING_METHODS.add(name)
+
+for _kernel in ERROR_DIFFUSION_KERNELS:
+    register_dithering_method(_kernel, partial(apply_error_diffusion_dithering, kernel=_kernel))
+    register_dithering_method(f'{_kernel}-serpentine',
+                              partial(apply_error_diffusion_dithering, kernel=_kernel, serpentine=True))
+    register_dithering_method(f'{_kernel}-parallel', partial(apply_wavefront_dithering, kernel=_kernel),
+                              multiprocess=True)
+register_dithering_method('bayer', partial(apply_ordered_dithering, workers=os.cpu_count() or 1))
+register_dithering_method('blue-noise', partial(apply_ordered_dithering, threshold=blue_noise_matrix(),
+                                                workers=os.cpu_count() or 1))
+
+def apply_dithering(image, target_color_palette = default_color_palette, method = None):
+    """Dither the image with a registered method (Floyd-Steinberg if none is given)."""
+    method = method or DEFAULT_DITHERING_METHOD
+    if method not in DITHERING_METHODS:
+        raise ValueError(f"Unknown dithering method: {method}")
+    return DITHERING_METHODS[method](image, target_color_palette)
+
+def image_to_palette_codes(image, target_color_palette = default_color_palette):
+    """Convert a dithered image to one palette code byte per pixel (unknown colors map to white)."""
+    pixels = np.array(image.convert('RGB'), dtype=np.uint32)
+    keys = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+    codes = np.full(keys.shape, 0xFF, dtype=np.uint8)
+    for rgb, code in target_color_palette.items():
+        codes[keys == ((rgb[0] << 16) | (rgb[1] << 8) | rgb[2])] = code
+    return codes.tobytes()
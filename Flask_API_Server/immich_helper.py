@@ -1,17 +1,51 @@
+import fcntl
 import json
 import os
 import random
+import threading
+import time
 import requests
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageOps, PngImagePlugin
 import io
 from typing import Optional, Tuple, Dict, List
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 from enum import Enum
 
+# Stored in cached originals. Bump it when their format changes so older files get downloaded again
+ORIGINAL_CACHE_VERSION = '2'  # 2: EXIF orientation applied
+# Saliency crops of assets without faces are redone after this long, face detection may have run since
+FACE_RECHECK_SECONDS = 24 * 3600
+
 class ImmichScaleMode(Enum):
     PAD = "pad"  # Add white padding
     CROP = "crop"  # Crop to fit
+    SMART = "smart"  # Crop to fit, keeping faces or the most detailed region in frame
+
+def _best_window_start(weights: np.ndarray, window: int) -> int:
+    """Start of the window over a 1D weight profile holding the most weight
+
+    Near-ties go to the window best centered on the weight, so flat content gives a center crop.
+    """
+    sums = np.convolve(weights, np.ones(window), mode='valid')
+    candidates = np.flatnonzero(sums >= sums.max() * 0.98)
+    positions = np.arange(len(weights)) + 0.5
+    centroid = (weights * positions).sum() / weights.sum() if weights.sum() > 0 else len(weights) / 2
+    return int(candidates[np.argmin(np.abs(candidates + window / 2 - centroid))])
+
+def _saliency_map(img: Image.Image, size: int = 96) -> np.ndarray:
+    """Rough saliency of an image, computed on a thumbnail: edge density plus distance from the mean color"""
+    small = img.convert('RGB')
+    small.thumbnail((size, size))
+    pixels = np.asarray(small, dtype=np.float32)
+    luma = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    edges = np.zeros_like(luma)
+    edges[:, 1:] += np.abs(np.diff(luma, axis=1))
+    edges[1:, :] += np.abs(np.diff(luma, axis=0))
+    color = np.linalg.norm(pixels - pixels.reshape(-1, 3).mean(axis=0), axis=2)
+    return edges / (edges.max() + 1e-6) + color / (color.max() + 1e-6)
     
 class ImmichHelper:
     DEFAULT_CONFIG = {
@@ -36,6 +70,15 @@ class ImmichHelper:
         self.groups_path = self.image_path / "groups"
         self.groups_path.mkdir(parents=True, exist_ok=True)
         self.image_path.mkdir(parents=True, exist_ok=True)
+        
+        # Guards the group queue files against concurrent picks and prefetch passes in this
+        # process; _locked_group_queue adds a file lock for other instances sharing the volume
+        self._queue_lock = threading.Lock()
+        
+        # Smart crop windows per asset and aspect ratio, computed once
+        self.crop_windows_path = self.image_path / "crop_windows.json"
+        self._crop_windows = None
+        self._crop_lock = threading.Lock()
 
     def _load_or_create_config(self) -> dict:
         if self.config_path.exists():
@@ -72,12 +115,102 @@ class ImmichHelper:
             
         return album_data['assets']
 
-    def _download_asset(self, asset_id: str) -> bytes:
-        """Download asset from Immich server"""
+    def _download_asset(self, asset_id: str, limiter=None) -> bytes:
+        """Download asset from Immich server, optionally throttled by a bandwidth limiter"""
         url = f"{self.server_url}/api/assets/{asset_id}/original"
-        response = requests.get(url, headers=self._get_headers())
-        response.raise_for_status()
-        return response.content
+        if limiter is None:
+            response = requests.get(url, headers=self._get_headers())
+            response.raise_for_status()
+            return response.content
+        
+        with requests.get(url, headers=self._get_headers(), stream=True) as response:
+            response.raise_for_status()
+            data = bytearray()
+            for block in response.iter_content(64 * 1024):
+                limiter.consume(len(block))
+                data += block
+            return bytes(data)
+
+    def _get_asset_faces(self, asset_id: str) -> Optional[List[Tuple[float, float, float, float]]]:
+        """Get an asset's detected faces as (left, top, right, bottom) fractions of the image, None if unavailable"""
+        url = f"{self.server_url}/api/faces"
+        try:
+            response = requests.get(url, headers=self._get_headers(), params={'id': asset_id}, timeout=10)
+            if 400 <= response.status_code < 500:
+                # Older servers or keys without face access won't change soon, treat it as no faces
+                print(f"Face data not available for {asset_id}: HTTP {response.status_code}")
+                return []
+            response.raise_for_status()
+            faces = response.json()
+        except (requests.RequestException, ValueError) as e:
+            # Connection errors, timeouts and server errors are worth retrying on the next render
+            print(f"Face data temporarily unavailable for {asset_id}: {str(e)}")
+            return None
+        
+        boxes = []
+        for face in faces:
+            width, height = face.get('imageWidth'), face.get('imageHeight')
+            if width and height:
+                boxes.append((face['boundingBoxX1'] / width, face['boundingBoxY1'] / height,
+                              face['boundingBoxX2'] / width, face['boundingBoxY2'] / height))
+        return boxes
+
+    def _compute_crop_window(self, image_id: str, img: Image.Image, aspect: float):
+        """Pick the crop window of the given aspect ratio, as (left, top, right, bottom) fractions of the image
+
+        Returns the window and the faces it was based on (None if face data was unavailable).
+        """
+        # The window spans the whole image along one axis and slides along the other
+        horizontal = img.width / img.height > aspect
+        extent = aspect * img.height / img.width if horizontal else img.width / aspect / img.height
+        
+        faces = self._get_asset_faces(image_id)
+        if faces:
+            # Weight each face by its area, spread over the span it covers on the sliding axis
+            bins = 256
+            weights = np.zeros(bins)
+            for left, top, right, bottom in faces:
+                start, end = (left, right) if horizontal else (top, bottom)
+                first, last = int(start * bins), max(int(start * bins) + 1, int(np.ceil(end * bins)))
+                weights[max(first, 0):min(last, bins)] += (right - left) * (bottom - top) / (last - first)
+        else:
+            saliency = _saliency_map(img)
+            weights = saliency.sum(axis=0 if horizontal else 1)
+            bins = len(weights)
+        
+        window = max(1, min(bins, round(extent * bins)))
+        # Rounding the window to whole bins must not push it past the image edge
+        offset = min(_best_window_start(weights, window) / bins, 1.0 - extent)
+        if horizontal:
+            return (offset, 0.0, offset + extent, 1.0), faces
+        return (0.0, offset, 1.0, offset + extent), faces
+
+    def get_crop_window(self, image_id: str, img: Image.Image, aspect: float) -> Tuple[float, float, float, float]:
+        """Get the smart crop window for an image and panel aspect ratio, computing it only once"""
+        key = f"{image_id}:{aspect:.4f}"
+        with self._crop_lock:
+            if self._crop_windows is None:
+                try:
+                    with open(self.crop_windows_path, 'r') as f:
+                        self._crop_windows = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    self._crop_windows = {}
+            entry = self._crop_windows.get(key)
+            # Entries without face information predate rechecking and are recomputed
+            if isinstance(entry, dict) and (entry['faces'] or time.time() - entry['checked'] < FACE_RECHECK_SECONDS):
+                return tuple(entry['window'])
+        
+        window, faces = self._compute_crop_window(image_id, img, aspect)
+        if faces is None:
+            # Don't keep a saliency fallback caused by a failed request, retry faces next render
+            return window
+        with self._crop_lock:
+            self._crop_windows[key] = {'window': list(window), 'faces': bool(faces), 'checked': time.time()}
+            tmp_path = self.crop_windows_path.with_name(f"crop_windows.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(self._crop_windows, f)
+            os.replace(tmp_path, self.crop_windows_path)
+        return window
 
     def _get_group_tracking_file(self, group_id: str) -> Path:
         """Get the tracking file path for a specific group"""
@@ -103,9 +236,86 @@ class ImmichHelper:
         with open(tracking_file, 'w') as f:
             f.write('')
 
+    def _get_group_queue_file(self, group_id: str) -> Path:
+        """Get the file holding a group's upcoming image IDs, in shuffle order"""
+        return self.groups_path / f"{group_id}_queue.txt"
+
+    def _get_queued_ids_for_group(self, group_id: str) -> List[str]:
+        """Get the upcoming image IDs for a specific group"""
+        queue_file = self._get_group_queue_file(group_id)
+        if not queue_file.exists():
+            return []
+        with open(queue_file, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def _save_group_queue(self, group_id: str, image_ids: List[str]):
+        """Replace a group's upcoming image IDs"""
+        with open(self._get_group_queue_file(group_id), 'w') as f:
+            f.writelines(f"{image_id}\n" for image_id in image_ids)
+
+    @contextmanager
+    def _locked_group_queue(self, group_id: str):
+        """Hold a group's queue against other threads and, through a file lock, other server instances"""
+        with self._queue_lock:
+            with open(self.groups_path / f"{group_id}_queue.lock", 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield  # Closing the file releases the lock
+
+    def _fill_group_queue(self, asset_ids: List[str], group_id: str, count: int) -> List[str]:
+        """Extend a group's shuffle order to at least count images and return all of it"""
+        album_ids = set(asset_ids)
+        
+        # Drop images that left the album (or belong to a previous album) since they were queued
+        queue = [image_id for image_id in self._get_queued_ids_for_group(group_id) if image_id in album_ids]
+        tracked_ids = set(self._get_tracked_ids_for_group(group_id))
+        if album_ids and album_ids <= tracked_ids:
+            self._reset_group_tracking(group_id)
+            tracked_ids = set()
+        
+        while len(queue) < min(count, len(asset_ids)):
+            candidates = [image_id for image_id in asset_ids if image_id not in tracked_ids and image_id not in queue]
+            if not candidates:
+                # Everything left in this round is already queued, continue into the next round
+                candidates = [image_id for image_id in asset_ids if image_id not in queue]
+            random.shuffle(candidates)
+            queue += candidates[:count - len(queue)]
+        
+        self._save_group_queue(group_id, queue)
+        return queue
+
+    def get_upcoming_images(self, album_id: str, group_id: str, count: int) -> List[str]:
+        """Get the next count image IDs a group will show, in order"""
+        # Ask Immich before locking so other instances never wait on a network call
+        asset_ids = [asset['id'] for asset in self._get_album_assets(album_id)]
+        with self._locked_group_queue(group_id):
+            return self._fill_group_queue(asset_ids, group_id, count)[:count]
+
+    def next_image_id(self, album_id: str, group_id: Optional[str] = None) -> str:
+        """Pick the image to show next, moving it from the group's shuffle order to its tracking"""
+        assets = self._get_album_assets(album_id)
+        if not assets:
+            raise ValueError("No images available in the album")
+        if not group_id:
+            return random.choice(assets)['id']
+        
+        with self._locked_group_queue(group_id):
+            queue = self._fill_group_queue([asset['id'] for asset in assets], group_id, 1)
+            image_id = queue.pop(0)
+            # Track it in the same locked step, otherwise a concurrent pick could queue it again
+            self._add_to_group_tracking(group_id, image_id)
+            self._save_group_queue(group_id, queue)
+            return image_id
+
     def scale_img_in_memory(self, img: Image.Image, target_width: int, target_height: int, 
-                        mode: ImmichScaleMode = ImmichScaleMode.PAD) -> Image.Image:
+                        mode: ImmichScaleMode = ImmichScaleMode.PAD,
+                        crop_window: Optional[Tuple[float, float, float, float]] = None) -> Image.Image:
         """Scale image to target size using specified mode"""
+        if mode == ImmichScaleMode.SMART and crop_window:
+            # The window already has the target aspect ratio, crop to it and resize
+            left, top, right, bottom = crop_window
+            box = (round(left * img.width), round(top * img.height), round(right * img.width), round(bottom * img.height))
+            return img.resize((target_width, target_height), Image.Resampling.LANCZOS, box=box)
+        
         # First scale image maintaining aspect ratio
         width_ratio = target_width / img.width
         height_ratio = target_height / img.height
@@ -141,50 +351,35 @@ class ImmichHelper:
     def get_random_image(self, album_id: str, width: Optional[int] = None, height: Optional[int] = None,
                       scale_mode: ImmichScaleMode = ImmichScaleMode.PAD, group_id: Optional[str] = None) -> Tuple[str, bytes]:
         """Get random image, optionally tracking per group"""
-        # Get all available assets from album
-        assets = self._get_album_assets(album_id)
-        if not assets:
-            raise ValueError("No images available in the album")
-        
-        # Handle group tracking if group_id is provided
-        if group_id:
-            tracked_ids = self._get_tracked_ids_for_group(group_id)
-            untracked_assets = [asset for asset in assets if asset['id'] not in tracked_ids]
-            
-            if not untracked_assets:
-                self._reset_group_tracking(group_id)
-                untracked_assets = assets
-        else:
-            untracked_assets = assets
-        
-        # Select random untracked asset
-        chosen_asset = random.choice(untracked_assets)
-        image_id = chosen_asset['id']
+        image_id = self.next_image_id(album_id, group_id)
         
         try:
             # Process image
             image_data = self._process_image(image_id, width, height, scale_mode)
-            
-            # Track the image if we're using group tracking
-            if group_id:
-                self._add_to_group_tracking(group_id, image_id)
-                
             return image_id, image_data
             
         except Exception as e:
             print(f"Error processing image {image_id}: {str(e)}")
             raise ValueError(f"Failed to process image: {str(e)}")
 
-    def add_image(self, image_id: str, image_data: bytes):
-        """Add new image to cache only"""
+    def add_image(self, image_id: str, image_data: bytes) -> int:
+        """Add new image to cache only, returning its size on disk"""
         try:
             # Convert bytes directly to Image
             img = Image.open(io.BytesIO(image_data))
+            # Apply the EXIF orientation, Immich's face boxes refer to the upright image
+            img = ImageOps.exif_transpose(img)
             img = img.convert('RGB')
             
             save_path = self.image_path / f"{image_id}.png"
             save_path.parent.mkdir(parents=True, exist_ok=True)
-            img.save(save_path, 'PNG')
+            # Write under a temporary name so a concurrent reader never opens a partial file
+            tmp_path = save_path.with_name(f"{image_id}.{os.getpid()}.{threading.get_ident()}.tmp")
+            info = PngImagePlugin.PngInfo()
+            info.add_text('cache-version', ORIGINAL_CACHE_VERSION)
+            img.save(tmp_path, 'PNG', pnginfo=info)
+            os.replace(tmp_path, save_path)
+            return save_path.stat().st_size
         except Exception as e:
             print(f"Image processing error: {str(e)}")  # Add debug print
             raise ValueError(f"Failed to process image: {str(e)}")
@@ -197,23 +392,41 @@ class ImmichHelper:
         self.config['immich'].update(new_config)
         self._save_config(self.config)
 
+    def _is_current_original(self, image_path: Path) -> bool:
+        """Whether a cached original exists in the current format; older ones (e.g. not upright) are replaced"""
+        try:
+            # Only reads the header, the version is a text chunk ahead of the pixel data
+            with Image.open(image_path) as img:
+                return img.info.get('cache-version') == ORIGINAL_CACHE_VERSION
+        except (FileNotFoundError, OSError):
+            return False
+
+    def cache_image(self, image_id: str, limiter=None) -> int:
+        """Download an image into the cache unless it's there, returning the bytes added to disk"""
+        image_path = self.image_path / f"{image_id}.png"
+        if self._is_current_original(image_path):
+            return 0
+        image_data = self._download_asset(image_id, limiter)
+        if not image_data:
+            raise ValueError("Failed to download image data")
+        return self.add_image(image_id, image_data)
+
     def _process_image(self, image_id: str, width: Optional[int], height: Optional[int], 
                       scale_mode: ImmichScaleMode) -> bytes:
         """Process an image with the given parameters"""
         # Download or get cached image
+        self.cache_image(image_id)
         image_path = self.image_path / f"{image_id}.png"
-        if not image_path.exists():
-            image_data = self._download_asset(image_id)
-            if not image_data:
-                raise ValueError("Failed to download image data")
-            self.add_image(image_id, image_data)
 
         # Process image
         with Image.open(image_path) as img:
             img = img.convert('RGB')
             
             if width and height:
-                img = self.scale_img_in_memory(img, width, height, scale_mode)
+                crop_window = None
+                if scale_mode == ImmichScaleMode.SMART:
+                    crop_window = self.get_crop_window(image_id, img, width / height)
+                img = self.scale_img_in_memory(img, width, height, scale_mode, crop_window)
             
             if self.config['immich']['rotation']:
                 img = img.rotate(self.config['immich']['rotation'], expand=True)
@@ -225,6 +438,11 @@ class ImmichHelper:
             
             return img_byte_arr.getvalue()
 
+    def get_image(self, image_id: str, width: Optional[int] = None, height: Optional[int] = None,
+                  scale_mode: ImmichScaleMode = ImmichScaleMode.PAD) -> bytes:
+        """Get a specific image scaled for a panel, downloading it if it isn't cached"""
+        return self._process_image(image_id, width, height, scale_mode)
+
     def get_tracked_ids(self) -> List[str]:
         """Public method to access tracked IDs - now uses group tracking"""
         return []  # No global tracking anymore, only per-group
@@ -0,0 +1,320 @@
+"""Load generator that behaves like a fleet of ESP32 photo frames.
+
+Each simulated frame runs the firmware's wake-up sequence (see GDEP073E01.ino):
+register at /device-register, log, fetch /wakeup-interval, call /init-transfer,
+download every /get-chunk with its buffer_size and log the result. Frames wake
+at random offsets within a jitter window and can be given a slow Wi-Fi link
+(round trip delay, bandwidth cap and a small TCP receive window like the ESP32's).
+
+For every fleet size it reports latency percentiles per endpoint, throughput,
+failures and the server's peak memory.
+
+Usage, against a server and Immich stub it launches itself:
+    python fleet_simulator.py --launch-server --fleet-sizes 10,50,200 --jitter 5 --bandwidth 50000
+
+Or against a running server (its album must be reachable from that server):
+    python fleet_simulator.py --server http://127.0.0.1:9999 --album <album_id> --server-pid <pid>
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from immich_stub import STUB_ALBUM_ID, ImmichStub
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+
+class SlowConnection(http.client.HTTPConnection):
+    """HTTP connection with a small receive window, like the ESP32's lwIP stack"""
+
+    def __init__(self, host, port, timeout, receive_window):
+        super().__init__(host, port, timeout=timeout)
+        self.receive_window = receive_window
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.receive_window:
+            # Must be set before connecting for the advertised window to shrink
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_window)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect((self.host, self.port))
+
+class FleetStats:
+    """Thread-safe collection of request timings"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.failures: Dict[str, int] = {}
+        self.bytes_received = 0
+        self.completed_wakes = 0
+
+    def record(self, endpoint: str, seconds: float, ok: bool, size: int = 0):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+            self.bytes_received += size
+
+class SimulatedFrame:
+    """One photo frame running the firmware's wake-up sequence"""
+
+    def __init__(self, device_id: str, server_url: str, width: int, height: int, buffer_size: int,
+                 palette_size: int = 7, rtt: float = 0.0, bandwidth: Optional[int] = None,
+                 receive_window: Optional[int] = 5744, timeout: float = 30.0):
+        url = urlparse(server_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.device_id = device_id
+        self.width = width
+        self.height = height
+        self.buffer_size = buffer_size
+        self.palette_size = palette_size
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.receive_window = receive_window
+        self.timeout = timeout
+        self.wake_count = 0
+        self.wake_started = 0.0
+        self.pending_logs: List[dict] = []
+
+    def request(self, method: str, path: str, body: Optional[dict] = None):
+        """Send one request over a fresh connection (the firmware never reuses them)"""
+        # Connection setup and the request itself each cost a round trip
+        time.sleep(self.rtt * 2)
+        conn = SlowConnection(self.host, self.port, self.timeout, self.receive_window)
+        try:
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = conn.getresponse()
+            data = bytearray()
+            started = time.monotonic()
+            while True:
+                segment = response.read(1460)
+                if not segment:
+                    break
+                data += segment
+                if self.bandwidth:
+                    # Pace reads so the link never exceeds its bandwidth
+                    ahead = len(data) / self.bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            return response.status, bytes(data)
+        finally:
+            conn.close()
+
+    def timed(self, stats: FleetStats, endpoint: str, method: str, path: str, body: Optional[dict] = None):
+        started = time.monotonic()
+        try:
+            status, data = self.request(method, path, body)
+        except (OSError, http.client.HTTPException):
+            stats.record(endpoint, time.monotonic() - started, False)
+            return None, b''
+        stats.record(endpoint, time.monotonic() - started, status == 200, len(data))
+        return status, data
+
+    def registration(self) -> dict:
+        return {
+            'device_id': self.device_id,
+            'name': 'Load test frame',
+            'width': self.width,
+            'height': self.height,
+            'dithering_palette_size': self.palette_size,
+            'buffer_size': self.buffer_size,
+            'free_space': 200000
+        }
+
+    def log(self, stats: FleetStats, message: str, level: str = 'INFO'):
+        # Buffered like the firmware and sent in one batch before sleeping
+        self.pending_logs.append({'message': message, 'level': level, 'wake': self.wake_count,
+                                  'ms': int((time.monotonic() - self.wake_started) * 1000)})
+
+    def flush_logs(self, stats: FleetStats):
+        status, _ = self.timed(stats, '/device-logs', 'POST', '/device-logs',
+                               {'device_id': self.device_id, 'dropped': 0, 'entries': self.pending_logs})
+        if status == 200:
+            self.pending_logs = []
+
+    def wake(self, stats: FleetStats) -> bool:
+        """Run one wake-up, returning whether the frame got a complete image"""
+        self.wake_count += 1
+        self.wake_started = time.monotonic()
+        try:
+            return self.transfer(stats)
+        finally:
+            self.log(stats, 'Setting sleep timer')
+            self.flush_logs(stats)
+
+    def transfer(self, stats: FleetStats) -> bool:
+        """Register and download a frame, the part of the wake-up that talks to the server"""
+        status, _ = self.timed(stats, '/device-register', 'POST', '/device-register', self.registration())
+        if status != 200:
+            return False
+        self.log(stats, 'Connected to backend, exiting broadcast mode')
+        self.timed(stats, '/wakeup-interval', 'GET', '/wakeup-interval')
+
+        status, data = self.timed(stats, '/init-transfer', 'POST', '/init-transfer', {'device_id': self.device_id})
+        if status != 200:
+            self.log(stats, 'Failed to initialize transfer', 'ERROR')
+            return False
+        transfer = json.loads(data)
+
+        for index in range(transfer['total_chunks']):
+            status, data = self.timed(stats, '/get-chunk', 'GET',
+                                      f"/get-chunk/{transfer['transfer_id']}/{index}")
+            if status != 200 or len(data) != self.buffer_size:
+                self.log(stats, 'Failed to fetch chunks', 'ERROR')
+                return False
+
+        self.log(stats, 'Image transfer successful, all tasks succeeded')
+        with stats.lock:
+            stats.latencies.setdefault('wake', []).append(time.monotonic() - self.wake_started)
+            stats.completed_wakes += 1
+        return True
+
+def api_call(server_url: str, method: str, path: str, body: Optional[dict] = None) -> dict:
+    """Plain JSON call used to set up the fleet"""
+    url = urlparse(server_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+    try:
+        conn.request(method, path, json.dumps(body) if body is not None else None,
+                     {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{method} {path} failed with {response.status}: {data[:200]!r}")
+        return json.loads(data)
+    finally:
+        conn.close()
+
+def prepare_fleet(server_url: str, frames: List[SimulatedFrame], album_id: str):
+    """Register every frame and put them all in a group showing the album"""
+    group_id = api_call(server_url, 'POST', '/groups', {'name': 'Load test'})['group_id']
+    api_call(server_url, 'PUT', f'/groups/{group_id}', {'album': album_id})
+    for frame in frames:
+        api_call(server_url, 'POST', '/device-register', frame.registration())
+        api_call(server_url, 'PUT', f'/devices/{frame.device_id}/group', {'group_id': group_id, 'was_assigned': True})
+    return group_id
+
+def read_rss(pid: int) -> Optional[int]:
+    """Resident memory of a process in bytes (Linux only)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))]
+
+def run_round(args, fleet_size: int, server_pid: Optional[int]) -> dict:
+    """Wake a fleet of the given size once and collect its numbers"""
+    frames = [
+        SimulatedFrame(f'load-{fleet_size}-{i:05d}', args.server, args.width, args.height, args.buffer_size,
+                       rtt=args.rtt, bandwidth=args.bandwidth, receive_window=args.receive_window)
+        for i in range(fleet_size)
+    ]
+    prepare_fleet(args.server, frames, args.album)
+
+    stats = FleetStats()
+    peak_rss = [read_rss(server_pid) if server_pid else None]
+    done = threading.Event()
+
+    def sample_memory():
+        while not done.wait(0.2):
+            rss = read_rss(server_pid)
+            if rss and (peak_rss[0] is None or rss > peak_rss[0]):
+                peak_rss[0] = rss
+
+    if server_pid:
+        threading.Thread(target=sample_memory, daemon=True).start()
+
+    def wake_later(frame: SimulatedFrame):
+        time.sleep(random.uniform(0, args.jitter))
+        return frame.wake(stats)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=fleet_size) as executor:
+        list(executor.map(wake_later, frames))
+    elapsed = time.monotonic() - started
+    done.set()
+
+    return {'fleet_size': fleet_size, 'elapsed': elapsed, 'stats': stats, 'peak_rss': peak_rss[0]}
+
+def print_report(result: dict):
+    stats = result['stats']
+    print(f"\n=== Fleet of {result['fleet_size']} frames ===")
+    print(f"Completed wakes: {stats.completed_wakes}/{result['fleet_size']} in {result['elapsed']:.1f}s "
+          f"({stats.completed_wakes / result['elapsed']:.2f} wakes/s, "
+          f"{stats.bytes_received / result['elapsed'] / 1024:.0f} KiB/s)")
+    if result['peak_rss']:
+        print(f"Server peak RSS: {result['peak_rss'] / 1024 / 1024:.1f} MiB")
+    print(f"{'endpoint':<18}{'count':>7}{'fail':>6}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for endpoint, values in sorted(stats.latencies.items()):
+        print(f"{endpoint:<18}{len(values):>7}{stats.failures.get(endpoint, 0):>6}"
+              + ''.join(f"{percentile(values, p):>8.3f}s" for p in (50, 90, 99, 100)))
+
+def launch_server(args) -> subprocess.Popen:
+    """Start the server against an Immich stub, in a scratch config directory"""
+    stub = ImmichStub(port=args.stub_port, assets=args.assets, latency=args.stub_latency).start()
+    workdir = tempfile.mkdtemp(prefix='frame-load-test-')
+    env = dict(os.environ, IMMICH_URL=stub.url, IMMICH_API_KEY='load-test', HOST_IP='127.0.0.1',
+               IMAGE_PATH=os.path.join(workdir, 'images'))
+    server = subprocess.Popen([sys.executable, str(SERVER_DIR / 'flask_server.py')], cwd=workdir, env=env,
+                              stdout=subprocess.DEVNULL if not args.server_output else None,
+                              stderr=subprocess.STDOUT if not args.server_output else None)
+
+    # Wait for the server to finish loading its state
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            api_call(args.server, 'GET', '/ready')
+            return server
+        except (OSError, RuntimeError, http.client.HTTPException):
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('Server did not become ready within 30 seconds')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a fleet of ESP32 photo frames waking up')
+    parser.add_argument('--server', default='http://127.0.0.1:9999', help='Server base URL')
+    parser.add_argument('--album', default=STUB_ALBUM_ID, help='Album the load test group shows')
+    parser.add_argument('--fleet-sizes', default='10,50,100', help='Comma separated fleet sizes, run in order')
+    parser.add_argument('--jitter', type=float, default=5.0, help='Frames wake within this many seconds')
+    parser.add_argument('--width', type=int, default=800, help='Panel width')
+    parser.add_argument('--height', type=int, default=480, help='Panel height')
+    parser.add_argument('--buffer-size', type=int, default=48000, help='Chunk size, a multiple of the width')
+    parser.add_argument('--rtt', type=float, default=0.0, help='Simulated Wi-Fi round trip time in seconds')
+    parser.add_argument('--bandwidth', type=int, default=None, help='Simulated Wi-Fi bandwidth in bytes/s')
+    parser.add_argument('--receive-window', type=int, default=5744, help='TCP receive buffer, 0 for the OS default')
+    parser.add_argument('--server-pid', type=int, default=None, help='Server process to sample memory from')
+    parser.add_argument('--launch-server', action='store_true', help='Start the server and an Immich stub')
+    parser.add_argument('--server-output', action='store_true', help='Show the launched server output')
+    parser.add_argument('--stub-port', type=int, default=2283, help='Immich stub port')
+    parser.add_argument('--assets', type=int, default=50, help='Assets in the stub album')
+    parser.add_argument('--stub-latency', type=float, default=0.0, help='Seconds added to stub responses')
+    args = parser.parse_args()
+
+    server = launch_server(args) if args.launch_server else None
+    try:
+        for fleet_size in [int(size) for size in args.fleet_sizes.split(',')]:
+            print_report(run_round(args, fleet_size, server.pid if server else args.server_pid))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
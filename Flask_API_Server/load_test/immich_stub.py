@@ -0,0 +1,106 @@
+"""Minimal stand-in for the Immich API, for load testing the server.
+
+Serves one album of synthetic photos through the endpoints the server uses:
+    GET /api/albums
+    GET /api/albums/<album_id>
+    GET /api/assets/<asset_id>/original
+
+Usage:
+    python immich_stub.py --port 2283 --assets 50 --latency 0.05
+"""
+import argparse
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+STUB_ALBUM_ID = 'load-test-album'
+
+def make_photo(seed: int, width: int, height: int) -> bytes:
+    """Render a JPEG with smooth gradients and some noise, roughly like a photo to dither"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = []
+    for _ in range(3):
+        fx, fy, phase = rng.uniform(0.5, 4, 2).tolist() + [rng.uniform(0, 6.28)]
+        channels.append(127 + 100 * np.sin(x / width * fx * 6.28 + phase) * np.cos(y / height * fy * 6.28))
+    pixels = np.stack(channels, axis=-1) + rng.normal(0, 12, (height, width, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+class ImmichStub:
+    """Threaded HTTP server answering like Immich"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 2283, assets: int = 20,
+                 width: int = 1600, height: int = 1200, latency: float = 0.0):
+        self.latency = latency
+        # A handful of distinct photos is enough, assets reuse them round-robin
+        self.photos = [make_photo(seed, width, height) for seed in range(min(assets, 8))]
+        self.assets = [{'id': f'asset-{i:05d}', 'type': 'IMAGE'} for i in range(assets)]
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, body: bytes, content_type: str, status: int = 200):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                parts = self.path.strip('/').split('/')
+                if parts == ['api', 'albums']:
+                    albums = [{'id': STUB_ALBUM_ID, 'albumName': 'Load test', 'assets': stub.assets}]
+                    self._send(json.dumps(albums).encode(), 'application/json')
+                elif parts[:2] == ['api', 'albums'] and len(parts) == 3:
+                    album = {'id': parts[2], 'albumName': 'Load test', 'assets': stub.assets}
+                    self._send(json.dumps(album).encode(), 'application/json')
+                elif parts[:2] == ['api', 'assets'] and len(parts) == 4 and parts[3] == 'original':
+                    index = int(parts[2].rsplit('-', 1)[-1]) if parts[2].startswith('asset-') else 0
+                    self._send(stub.photos[index % len(stub.photos)], 'image/jpeg')
+                else:
+                    self._send(b'{"message":"Not found"}', 'application/json', 404)
+
+        return Handler
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve in a background thread"""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Immich API stub for load testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2283)
+    parser.add_argument('--assets', type=int, default=20, help='Number of assets in the album')
+    parser.add_argument('--width', type=int, default=1600, help='Width of the original photos')
+    parser.add_argument('--height', type=int, default=1200, help='Height of the original photos')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    args = parser.parse_args()
+
+    stub = ImmichStub(args.host, args.port, args.assets, args.width, args.height, args.latency)
+    print(f"Immich stub serving album {STUB_ALBUM_ID} with {args.assets} assets on {stub.url}")
+    stub.server.serve_forever()
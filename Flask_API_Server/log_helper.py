@@ -0,0 +1,54 @@
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+class DeviceLogStore:
+    """Per-device log files, rotated by size
+
+    Each device appends to <root>/<device_id>.log. When a file would grow past
+    max_bytes it is renamed to .log.1 (shifting older ones up to backup_count)
+    and a fresh file is started.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 1024 * 1024, backup_count: int = 3):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def _path(self, device_id: str) -> Path:
+        # Device ids come from the request, keep them from escaping the log directory
+        return self.root / f"{re.sub(r'[^A-Za-z0-9_-]', '_', device_id)}.log"
+
+    def _lock(self, device_id: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(device_id, threading.Lock())
+
+    def _rotate(self, path: Path):
+        for i in range(self.backup_count - 1, 0, -1):
+            older = path.with_name(f"{path.name}.{i}")
+            if older.exists():
+                os.replace(older, path.with_name(f"{path.name}.{i + 1}"))
+        if self.backup_count > 0:
+            os.replace(path, path.with_name(f"{path.name}.1"))
+        else:
+            path.unlink()
+
+    def append(self, device_id: str, lines: List[str]):
+        """Append lines to a device's log in a single write"""
+        if not lines:
+            return
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        path = self._path(device_id)
+        with self._lock(device_id):
+            try:
+                if path.stat().st_size + len(data) > self.max_bytes:
+                    self._rotate(path)
+            except FileNotFoundError:
+                pass
+            with open(path, 'ab') as f:
+                f.write(data)
@@ -0,0 +1,37 @@
+import os
+import threading
+import time
+from typing import Optional
+
+class BandwidthLimiter:
+    """Token bucket shared by background downloads so they leave room for device transfers"""
+
+    def __init__(self, bytes_per_second: float, burst: Optional[float] = None):
+        self.rate = bytes_per_second
+        self.capacity = burst or bytes_per_second
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size: int):
+        """Wait until size bytes may be transferred"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Go into debt rather than splitting the block, later callers wait it off
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+def directory_size(path: str) -> int:
+    """Total size in bytes of the files under a directory"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
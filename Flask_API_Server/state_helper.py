@@ -0,0 +1,171 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+class StateBackend:
+    """Namespaced key/value store for server state.
+
+    Values are JSON-serializable objects or raw bytes. Keys may be given a
+    time-to-live in seconds, after which they read as missing.
+    """
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def items(self, namespace: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def incr(self, namespace: str, key: str, ttl: Optional[float] = None) -> int:
+        """Atomically increment an integer counter and return its new value"""
+        raise NotImplementedError
+
+    def purge_expired(self):
+        """Drop expired keys"""
+        pass
+
+class MemoryStateBackend(StateBackend):
+    """State kept in this process only"""
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, tuple]] = {}
+        self._lock = threading.Lock()
+
+    def _live(self, namespace: str, key: str):
+        entry = self._data.get(namespace, {}).get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < time.time():
+            del self._data[namespace][key]
+            return None
+        return entry
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            entry = self._live(namespace, key)
+            return default if entry is None else entry[0]
+
+    def set(self, namespace, key, value, ttl=None):
+        with self._lock:
+            self._data.setdefault(namespace, {})[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._data.get(namespace, {}).pop(key, None)
+
+    def items(self, namespace):
+        with self._lock:
+            keys = list(self._data.get(namespace, {}))
+            return {key: entry[0] for key in keys if (entry := self._live(namespace, key)) is not None}
+
+    def incr(self, namespace, key, ttl=None):
+        with self._lock:
+            entry = self._live(namespace, key)
+            value = (entry[0] if entry else 0) + 1
+            self._data.setdefault(namespace, {})[key] = (value, time.time() + ttl if ttl else None)
+            return value
+
+    def purge_expired(self):
+        with self._lock:
+            now = time.time()
+            for entries in self._data.values():
+                for key in [k for k, entry in entries.items() if entry[1] is not None and entry[1] < now]:
+                    del entries[key]
+
+class SqliteStateBackend(StateBackend):
+    """State in a SQLite file, shared by every server process that opens it"""
+
+    def __init__(self, db_path: str):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS state (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB,
+                    is_bytes INTEGER NOT NULL,
+                    expires_at REAL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value), 1
+        return json.dumps(value), 0
+
+    @staticmethod
+    def _decode(value, is_bytes):
+        return bytes(value) if is_bytes else json.loads(value)
+
+    def get(self, namespace, key, default=None):
+        row = self._connect().execute(
+            'SELECT value, is_bytes FROM state WHERE namespace = ? AND key = ? '
+            'AND (expires_at IS NULL OR expires_at >= ?)',
+            (namespace, key, time.time())).fetchone()
+        return default if row is None else self._decode(*row)
+
+    def set(self, namespace, key, value, ttl=None):
+        value, is_bytes = self._encode(value)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO state (namespace, key, value, is_bytes, expires_at) VALUES (?, ?, ?, ?, ?)',
+                (namespace, key, value, is_bytes, time.time() + ttl if ttl else None))
+
+    def delete(self, namespace, key):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def items(self, namespace):
+        rows = self._connect().execute(
+            'SELECT key, value, is_bytes FROM state WHERE namespace = ? '
+            'AND (expires_at IS NULL OR expires_at >= ?)',
+            (namespace, time.time())).fetchall()
+        return {key: self._decode(value, is_bytes) for key, value, is_bytes in rows}
+
+    def incr(self, namespace, key, ttl=None):
+        conn = self._connect()
+        with conn:
+            # Take the write lock up front so concurrent increments serialize
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT value FROM state WHERE namespace = ? AND key = ? '
+                'AND (expires_at IS NULL OR expires_at >= ?)',
+                (namespace, key, time.time())).fetchone()
+            value = (json.loads(row[0]) if row else 0) + 1
+            conn.execute(
+                'INSERT OR REPLACE INTO state (namespace, key, value, is_bytes, expires_at) VALUES (?, ?, ?, 0, ?)',
+                (namespace, key, json.dumps(value), time.time() + ttl if ttl else None))
+        return value
+
+    def purge_expired(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at < ?', (time.time(),))
+
+def create_state_backend(kind: str = 'memory', db_path: str = './config/state.db') -> StateBackend:
+    """Create the state backend selected by name ('memory' or 'sqlite')"""
+    if kind == 'memory':
+        return MemoryStateBackend()
+    if kind == 'sqlite':
+        return SqliteStateBackend(db_path)
+    raise ValueError(f"Unknown state backend: {kind}")
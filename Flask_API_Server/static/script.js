@@ -2,6 +2,8 @@ const AUTO_ASSIGN_KEY = 'autoAssignGroup';
 
 const socket = io();
 
+let ditheringMethods = [];
+
 socket.on('connect', () => {
     console.log('Connected to WebSocket');
     loadInitialState(); // Reload state when reconnecting
@@ -30,10 +32,20 @@ function createDeviceEntry(device, deviceId) {
     scaleMode.innerHTML = `
         <option value="crop" ${device.scale_mode === 'crop' ? 'selected' : ''}>Crop</option>
         <option value="pad" ${device.scale_mode === 'pad' ? 'selected' : ''}>Pad</option>
+        <option value="smart" ${device.scale_mode === 'smart' ? 'selected' : ''}>Smart</option>
     `;
     scaleMode.addEventListener('change', () => updateDeviceConfig(deviceId, { scale_mode: scaleMode.value }));
     
+    // Add dithering dropdown, empty value uses the group's method
+    const dithering = document.createElement('select');
+    dithering.className = 'device-dithering';
+    dithering.innerHTML = `<option value="">Group dithering</option>` + ditheringMethods.map(method =>
+        `<option value="${method}" ${device.dithering === method ? 'selected' : ''}>${method}</option>`
+    ).join('');
+    dithering.addEventListener('change', () => updateDeviceConfig(deviceId, { dithering: dithering.value }));
+    
     deviceControls.appendChild(scaleMode);
+    deviceControls.appendChild(dithering);
     deviceDiv.appendChild(deviceText);
     deviceDiv.appendChild(deviceControls);
     
@@ -266,6 +278,13 @@ function showGroupDetails(groupId) {
                 </div>
                 <label for="group-random">Random Order:</label>
                 <input type="checkbox" id="group-random" ${group.random ? 'checked' : ''} data-group-id="${groupId}">
+                <label for="group-dithering">Dithering:</label>
+                <select id="group-dithering" data-group-id="${groupId}">
+                    <option value="">Default</option>
+                    ${ditheringMethods.map(method =>
+                        `<option value="${method}" ${group.dithering === method ? 'selected' : ''}>${method}</option>`
+                    ).join('')}
+                </select>
                 <button id="delete-group" data-group-id="${groupId}">Delete Group</button>
                 <div class="group-devices">
                     <h3>Devices in Group</h3>
@@ -286,6 +305,7 @@ function showGroupDetails(groupId) {
             document.querySelector('.group-name').addEventListener('input', handleGroupNameChange);
             groupAlbumSelect.addEventListener('change', handleGroupAlbumChange);
             document.getElementById('group-random').addEventListener('change', handleGroupRandomChange);
+            document.getElementById('group-dithering').addEventListener('change', handleGroupDitheringChange);
             document.getElementById('delete-group').addEventListener('click', handleGroupDelete);
             
             // Add droppable functionality
@@ -497,6 +517,17 @@ function handleGroupRandomChange(event) {
     });
 }
 
+function handleGroupDitheringChange(event) {
+    const groupId = event.target.dataset.groupId;
+    fetch(`/groups/${groupId}`, {
+        method: 'PUT',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ dithering: event.target.value })
+    });
+}
+
 function handleGroupDelete(event) {
     const groupId = event.target.dataset.groupId;
     fetch(`/groups/${groupId}`, {
@@ -528,6 +559,7 @@ function showDeviceInfo(device) {
         <p><strong>IP:</strong> ${device.ip || 'Unknown'}</p>
         <p><strong>Status:</strong> ${device.active ? 'Active' : 'Hibernating'}</p>
         <p><strong>Scale Mode:</strong> ${device.scale_mode || 'crop'}</p>
+        <p><strong>Dithering:</strong> ${device.dithering || 'group default'}</p>
         <p><strong>First Seen:</strong> ${firstSeen}</p>
         <p><strong>Last Seen:</strong> ${lastSeen}</p>
         <p><strong>Width:</strong> ${device.width}</p>
@@ -619,8 +651,11 @@ function loadInitialState() {
     document.querySelectorAll('#group-tab-list li:not(#add-group-tab)').forEach(el => el.remove());
     document.querySelectorAll('#auto-group option:not([value="none"])').forEach(el => el.remove());
 
-    // Load devices
-    fetch('/devices')
+    // Load dithering methods first so device entries can list them, then devices
+    fetch('/dithering-methods')
+        .then(response => response.json())
+        .then(methods => { ditheringMethods = methods; })
+        .then(() => fetch('/devices'))
         .then(response => response.json())
         .then(deviceData => {
             console.log('Loading initial devices:', deviceData);